@@ -32,11 +32,17 @@ class SophiaG(Optimizer):
         self.bs = bs
         super(SophiaG, self).__init__(params, defaults)
 
+    def add_param_group(self, param_group):
+        super().add_param_group(param_group)
+        # Checked once here instead of for every parameter on every step, real-only models skip the complex handling
+        self._has_complex = any(torch.is_complex(p) for group in self.param_groups for p in group["params"])
+
     def __setstate__(self, state):
         super().__setstate__(state)
         for group in self.param_groups:
             group.setdefault("maximize", False)
             group.setdefault("capturable", False)
+        self._has_complex = any(torch.is_complex(p) for group in self.param_groups for p in group["params"])
         state_values = list(self.state.values())
         step_is_tensor = (len(state_values) != 0) and torch.is_tensor(state_values[0]["step"])
         if not step_is_tensor:
@@ -121,6 +127,7 @@ class SophiaG(Optimizer):
                 weight_decay=group["weight_decay"],
                 maximize=group["maximize"],
                 capturable=group["capturable"],
+                has_complex=self._has_complex,
             )
 
         return loss
@@ -141,6 +148,7 @@ def sophiag(
     lr: float,
     weight_decay: float,
     maximize: bool,
+    has_complex: bool = True,
 ):
 
     if not all(isinstance(t, torch.Tensor) for t in state_steps):
@@ -162,6 +170,7 @@ def sophiag(
         weight_decay=weight_decay,
         maximize=maximize,
         capturable=capturable,
+        has_complex=has_complex,
     )
 
 
@@ -180,10 +189,20 @@ def _single_tensor_sophiag(
     weight_decay: float,
     maximize: bool,
     capturable: bool,
+    has_complex: bool = True,
 ):
 
+    if capturable:
+        one_minus_wd = 1 - lr * weight_decay
+        rho_bs = rho * bs
+        step_size_neg = lr.neg()
+    else:
+        rho_bs = float(rho * bs)
+    # maximize negates the gradient through its coefficient in the first moment update, instead of a negated copy
+    grad_alpha = beta1 - 1 if maximize else 1 - beta1
+
     for i, param in enumerate(params):
-        grad = grads[i] if not maximize else -grads[i]
+        grad = grads[i]
         exp_avg = exp_avgs[i]
         hess = hessian[i]
         step_t = state_steps[i]
@@ -191,7 +210,7 @@ def _single_tensor_sophiag(
         if capturable:
             assert param.is_cuda and step_t.is_cuda and bs.is_cuda
 
-        if torch.is_complex(param):
+        if has_complex and torch.is_complex(param):
             grad = torch.view_as_real(grad)
             exp_avg = torch.view_as_real(exp_avg)
             hess = torch.view_as_real(hess)
@@ -200,22 +219,40 @@ def _single_tensor_sophiag(
         # update step
         step_t += 1
 
-        # Perform stepweight decay
-        param.mul_(1 - lr * weight_decay)
-
-        # Decay the first and second moment running average coefficient
-        exp_avg.mul_(beta1).add_(grad, alpha=1 - beta1)
-
         if capturable:
-            step = step_t
-            step_size = lr
-            step_size_neg = step_size.neg()
+            # Perform stepweight decay
+            if weight_decay != 0:
+                param.mul_(one_minus_wd)
+
+            # Decay the first and second moment running average coefficient
+            exp_avg.mul_(beta1).add_(grad, alpha=grad_alpha)
 
-            ratio = (exp_avg.abs() / (rho * bs * hess + 1e-15)).clamp(None, 1)
-            param.addcmul_(exp_avg.sign(), ratio, value=step_size_neg)
+            ratio = (exp_avg / (rho_bs * hess + 1e-15)).clamp_(-1, 1)
+            param.add_(ratio.mul_(step_size_neg))
         else:
-            step = step_t.item()
-            step_size_neg = -lr
+            _sophiag_update(param, grad, exp_avg, hess, lr, weight_decay, beta1, grad_alpha, rho_bs)
+
+
+# Scripted so that the pointwise ops can be fused, the scalars are floats as tensor scalars break the fusion
+@torch.jit.script
+def _sophiag_update(
+    param: Tensor,
+    grad: Tensor,
+    exp_avg: Tensor,
+    hess: Tensor,
+    lr: float,
+    weight_decay: float,
+    beta1: float,
+    grad_alpha: float,
+    rho_bs: float,
+):
+    # Perform stepweight decay, skipped without weight decay as it is a full pass over the parameter
+    if weight_decay != 0.0:
+        param.mul_(1 - lr * weight_decay)
+
+    # Decay the first and second moment running average coefficient
+    exp_avg.mul_(beta1).add_(grad, alpha=grad_alpha)
 
-            ratio = (exp_avg.abs() / (rho * bs * hess + 1e-15)).clamp(None, 1)
-            param.addcmul_(exp_avg.sign(), ratio, value=step_size_neg)
+    # sign(m) * clamp(|m| / d, max=1) == clamp(m / d, -1, 1), which saves the abs and sign passes
+    ratio = (exp_avg / (rho_bs * hess + 1e-15)).clamp_(-1.0, 1.0)
+    param.add_(ratio, alpha=-lr)
@@ -0,0 +1,33 @@
+import torch
+
+from cramming.backend.optimizers.sophiag import SophiaG
+
+
+def test__step__complex_group_added_after_construction__updates_complex_param():
+    real_param = torch.nn.Parameter(torch.randn(4))
+    complex_param = torch.nn.Parameter(torch.randn(4, dtype=torch.cfloat))
+    opt = SophiaG([real_param], lr=1e-2)
+    opt.add_param_group({"params": [complex_param]})
+
+    before = complex_param.detach().clone()
+    for p in (real_param, complex_param):
+        p.grad = torch.randn_like(p)
+    opt.update_hessian()
+    opt.step()
+
+    assert not torch.equal(before, complex_param.detach())
+
+
+def test__step__maximize__matches_step_on_negated_grads():
+    param = torch.randn(4)
+    grad = torch.randn(4)
+    results = []
+    for maximize, sign in ((True, 1), (False, -1)):
+        p = torch.nn.Parameter(param.clone())
+        opt = SophiaG([p], lr=1e-2, maximize=maximize)
+        p.grad = sign * grad
+        opt.update_hessian()
+        opt.step()
+        results.append(p.detach())
+
+    torch.testing.assert_close(results[0], results[1])
@@ -0,0 +1,198 @@
+from typing import Optional
+
+import torch
+import triton
+import triton.language as tl
+
+BLOCK_SIZE = 4096
+
+
+@triton.jit
+def _sophia_kernel(
+    param_ptr,
+    grad_ptr,
+    exp_avg_ptr,
+    hess_ptr,
+    rms_ptr,
+    hess_scale_ptr,
+    block_tensor_ptr,
+    n,
+    decay,
+    beta1,
+    grad_scale,
+    lookahead_beta,
+    lookahead_grad_scale,
+    rho_bs,
+    neg_lr,
+    HAS_LOOKAHEAD: tl.constexpr,
+    CLAMP_BY_RMS: tl.constexpr,
+    SCALE_BY_RMS: tl.constexpr,
+    HAS_HESS_SCALE: tl.constexpr,
+    PER_BLOCK_TENSOR: tl.constexpr,
+    HESS_BLOCK: tl.constexpr,
+    BLOCK: tl.constexpr,
+):
+    pid = tl.program_id(axis=0)
+    if PER_BLOCK_TENSOR:
+        # flat buffer of several tensors, each padded to whole blocks, the block selects
+        # the per-tensor scalars
+        t = tl.load(block_tensor_ptr + pid)
+        rms_ptr += t
+    offs = pid * BLOCK + tl.arange(0, BLOCK)
+    mask = offs < n
+
+    p = tl.load(param_ptr + offs, mask=mask).to(tl.float32)
+    g = tl.load(grad_ptr + offs, mask=mask).to(tl.float32)
+    ea = tl.load(exp_avg_ptr + offs, mask=mask).to(tl.float32)
+    h = tl.load(hess_ptr + offs, mask=mask).to(tl.float32)
+    if HAS_HESS_SCALE:
+        # dequantize the int8 hessian, the codes are 127 * sqrt(h / scale) with one
+        # scale per HESS_BLOCK elements
+        h = h / 127
+        h = h * h * tl.load(hess_scale_ptr + offs // HESS_BLOCK, mask=mask)
+
+    # stepweight decay and first moment running average, the look-ahead is taken from
+    # the moment before its update
+    p = p * decay
+    momentum = ea * lookahead_beta + g * lookahead_grad_scale
+    ea = ea * beta1 + g * grad_scale
+    if not HAS_LOOKAHEAD:
+        momentum = ea
+
+    # signed ratio, clamped to the trust region
+    max_ratio = 1.0
+    if CLAMP_BY_RMS:
+        max_ratio = tl.load(rms_ptr)
+    ratio = momentum / (rho_bs * h + 1e-15)
+    ratio = tl.minimum(tl.maximum(ratio, -max_ratio), max_ratio)
+
+    step_size_neg = neg_lr
+    if SCALE_BY_RMS:
+        step_size_neg = neg_lr * tl.load(rms_ptr)
+    p = p + step_size_neg * ratio
+
+    tl.store(param_ptr + offs, p.to(param_ptr.dtype.element_ty), mask=mask)
+    tl.store(exp_avg_ptr + offs, ea.to(exp_avg_ptr.dtype.element_ty), mask=mask)
+
+
+def sophia_update(
+    param: torch.Tensor,
+    grad: torch.Tensor,
+    exp_avg: torch.Tensor,
+    hess: torch.Tensor,
+    param_rms: torch.Tensor,
+    hess_scale: Optional[torch.Tensor] = None,
+    block_tensor: Optional[torch.Tensor] = None,
+    hess_block_size: int = 1,
+    *,
+    decay: float,
+    beta1: float,
+    rho_bs: float,
+    neg_lr: float,
+    clamp_by_rms: bool,
+    scale_by_rms: bool,
+    maximize: bool = False,
+    lookahead_beta: Optional[float] = None,
+):
+    """Single pass Sophia update of contiguous CUDA ``param`` and ``exp_avg``, in place.
+
+    ``param_rms`` is a one element device tensor with the (floored) RMS of the parameter
+    after weight decay. It is read by the kernel, so no host sync is needed.
+    ``hess_scale`` holds the scales of an int8 ``hess``, one per ``hess_block_size``
+    elements, which divides ``BLOCK_SIZE``.
+
+    With ``block_tensor``, the tensors are flat buffers holding several tensors, each
+    starting at a multiple of ``BLOCK_SIZE``. ``block_tensor`` is an int32 tensor with
+    the index of the tensor of every block, and ``param_rms`` holds one value per
+    tensor.
+
+    With ``maximize`` the gradient is negated, by its coefficient in the first moment
+    update. With ``lookahead_beta`` the ratio uses
+    ``lookahead_beta * exp_avg + (1 - lookahead_beta) * grad`` of the first moment
+    before its update.
+    """
+    if lookahead_beta is None:
+        lookahead_beta = 0.0
+        has_lookahead = False
+    else:
+        has_lookahead = True
+    n = param.numel()
+    grid = (triton.cdiv(n, BLOCK_SIZE),)
+    _sophia_kernel[grid](
+        param,
+        grad,
+        exp_avg,
+        hess,
+        param_rms,
+        hess_scale if hess_scale is not None else param_rms,
+        block_tensor if block_tensor is not None else param_rms,
+        n,
+        decay,
+        beta1,
+        beta1 - 1 if maximize else 1 - beta1,
+        lookahead_beta,
+        lookahead_beta - 1 if maximize else 1 - lookahead_beta,
+        rho_bs,
+        neg_lr,
+        HAS_LOOKAHEAD=has_lookahead,
+        CLAMP_BY_RMS=clamp_by_rms,
+        SCALE_BY_RMS=scale_by_rms,
+        HAS_HESS_SCALE=hess_scale is not None,
+        PER_BLOCK_TENSOR=block_tensor is not None,
+        HESS_BLOCK=hess_block_size,
+        BLOCK=BLOCK_SIZE,
+    )
+
+
+@triton.jit
+def _int8_hessian_ema_kernel(
+    hess_ptr,
+    grad_ptr,
+    scale_ptr,
+    n,
+    beta2,
+    HESS_BLOCK: tl.constexpr,
+):
+    # one program per scale, so that the new scale is known before the requantization
+    pid = tl.program_id(axis=0)
+    offs = pid * HESS_BLOCK + tl.arange(0, HESS_BLOCK)
+    mask = offs < n
+
+    code = tl.load(hess_ptr + offs, mask=mask, other=0).to(tl.float32) / 127
+    g = tl.load(grad_ptr + offs, mask=mask, other=0).to(tl.float32)
+    h = code * code * tl.load(scale_ptr + pid) * beta2 + g * g * (1 - beta2)
+
+    # the hessian is non-negative and the masked elements are 0, so the max of the block
+    # is its absmax, floored at the smallest normal float32
+    scale = tl.maximum(tl.max(h, axis=0), 1.1754943508222875e-38)
+    code = tl.floor(tl.sqrt(h / scale) * 127 + 0.5)
+
+    tl.store(scale_ptr + pid, scale)
+    tl.store(hess_ptr + offs, code.to(tl.int8), mask=mask)
+
+
+def int8_hessian_ema(
+    hess: torch.Tensor,
+    grad: torch.Tensor,
+    hess_scale: torch.Tensor,
+    *,
+    beta2: float,
+    hess_block_size: int,
+):
+    """Hessian EMA of a contiguous CUDA int8 ``hess``, requantized in place.
+
+    ``hess`` holds the codes ``round(127 * sqrt(hessian / scale))``, with one scale in
+    ``hess_scale`` per ``hess_block_size`` elements. Each block is read once and written
+    back with the max of its new hessian as its scale, without a float copy of the
+    hessian.
+    """
+    n = hess.numel()
+    grid = (triton.cdiv(n, hess_block_size),)
+    _int8_hessian_ema_kernel[grid](
+        hess,
+        grad,
+        hess_scale,
+        n,
+        beta2,
+        HESS_BLOCK=hess_block_size,
+    )
@@ -1,3 +1,13 @@
+import torch
+
+
+def _sophia_state_dtype(args):
+    # optim.state_dtype names a torch dtype, e.g. bfloat16, for the exp_avg and hessian
+    # of the SophiaG variants
+    state_dtype = args.optim.state_dtype
+    return None if state_dtype is None else getattr(torch, state_dtype)
+
+
 def get_optimizer(model, args):
     if args.optim.name == "adamwscale":
         from .copied import AdamWScale
@@ -22,6 +32,7 @@ def get_optimizer(model, args):
             rho=args.optim.rho,
             weight_decay=args.optim.weight_decay,
             lr=args.optim.base_lr,
+            state_dtype=_sophia_state_dtype(args),
         )
     elif args.optim.name == "sophiarms":
         from .sophia import SophiaG_RMS
@@ -31,6 +42,7 @@ def get_optimizer(model, args):
             rho=args.optim.rho,
             weight_decay=args.optim.weight_decay,
             lr=args.optim.base_lr,
+            state_dtype=_sophia_state_dtype(args),
         )
     elif args.optim.name == "sophiarmsd":
         from .sophia import SophiaG_RMSD
@@ -40,6 +52,7 @@ def get_optimizer(model, args):
             rho=args.optim.rho,
             weight_decay=args.optim.weight_decay,
             lr=args.optim.base_lr,
+            state_dtype=_sophia_state_dtype(args),
         )
     elif args.optim.name == "sophiaog":
         from .sophia import SophiaG_OG
@@ -49,6 +62,7 @@ def get_optimizer(model, args):
             rho=args.optim.rho,
             weight_decay=args.optim.weight_decay,
             lr=args.optim.base_lr,
+            state_dtype=_sophia_state_dtype(args),
         )
     else:
         raise NotImplementedError
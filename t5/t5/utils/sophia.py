@@ -1,14 +1,66 @@
 # Copied from https://github.com/Liuhong99/Sophia/blob/main/sophia.py
 
 import math
-from typing import List, Optional
+from typing import Dict, List, NamedTuple, Optional, Tuple
 
 import torch
 from torch import Tensor
 from torch.optim.optimizer import Optimizer
 
+try:
+    from ..kernels.sophia_triton import BLOCK_SIZE as _TRITON_BLOCK_SIZE
+    from ..kernels.sophia_triton import int8_hessian_ema as _triton_int8_hessian_ema
+    from ..kernels.sophia_triton import sophia_update as _triton_sophia_update
+
+    _HAS_TRITON = True
+except ImportError:
+    _HAS_TRITON = False
+
+_RMS_MODES = ("none", "clamp_rms", "rms_scale")
+
+# Number of elements of an int8 hessian that share one scale, it divides the Triton
+# block size so that the blocks of a flat buffer line up with those of its tensors
+HESSIAN_BLOCK_SIZE = 256
+
 
 class SophiaG(Optimizer):
+    """SophiaG, with the variants selected by ``rms_mode`` and ``lookahead_beta``.
+
+    ``rms_mode`` is one of
+
+    * ``"rms_scale"``: the ratio is clamped to 1 and the step is scaled by the RMS of
+      the parameter (SophiaG),
+    * ``"clamp_rms"``: the ratio is clamped to the RMS of the parameter (SophiaG_RMS),
+    * ``"none"``: the ratio is clamped to 1 (SophiaG_OG).
+
+    Except for ``"rms_scale"``, the RMS of every parameter is kept in ``state["rms"]``.
+    With ``lookahead_beta`` the ratio uses
+    ``lookahead_beta * exp_avg + (1 - lookahead_beta) * grad`` of the first moment
+    before its update (SophiaG_RMSD).
+
+    ``use_compile=True`` runs the per-tensor update compiled into one fused kernel by
+    TorchInductor, in place of the ``foreach`` update. ``use_triton`` takes precedence
+    over both for CUDA parameters.
+
+    ``state_dtype`` and ``hessian_dtype`` store exp_avg and the hessian in reduced
+    precision, they can be set per param group. ``hessian_dtype=torch.int8`` keeps the
+    hessian as codes with one scale per ``HESSIAN_BLOCK_SIZE`` elements, see
+    ``dequantize_hessian``. It requires ``use_triton=True`` and ``capturable=False``,
+    the Triton update and hessian EMA read the codes directly. Parameters that the
+    kernels do not take, e.g. on the CPU, go through a float32 copy of the hessian.
+
+    With ``flatten_state=True`` and ``use_triton=True``, the parameters with a gradient
+    and their exp_avg, hessian and rms state are moved into flat buffers, one per
+    (device, dtype), the first time a group is stepped. ``param.data`` becomes a view of
+    its buffer and every tensor starts at a multiple of the Triton block size. The
+    gradients are copied into a flat buffer by a single kernel, after which every buffer
+    is updated by one Triton launch. The buffers are rebuilt, by copy, when the set of
+    parameters with a gradient changes. Otherwise, and for groups with parameters that
+    are not on CUDA, the buffers are stacks of the parameters of one (device, dtype,
+    shape), each updated by one call of the per-tensor update, compiled with
+    ``use_compile=True`` except for ``rms_mode="rms_scale"``.
+    """
+
     def __init__(
         self,
         params,
@@ -18,7 +70,15 @@ class SophiaG(Optimizer):
         weight_decay=1e-1,
         *,
         maximize: bool = False,
-        capturable: bool = False
+        capturable: bool = False,
+        use_compile: bool = False,
+        foreach: bool = True,
+        use_triton: bool = False,
+        state_dtype: Optional[torch.dtype] = None,
+        hessian_dtype: Optional[torch.dtype] = None,
+        rms_mode: str = "rms_scale",
+        lookahead_beta: Optional[float] = None,
+        flatten_state: bool = False
     ):
         if not 0.0 <= lr:
             raise ValueError("Invalid learning rate: {}".format(lr))
@@ -30,6 +90,17 @@ class SophiaG(Optimizer):
             raise ValueError("Invalid rho parameter at index 1: {}".format(rho))
         if not 0.0 <= weight_decay:
             raise ValueError("Invalid weight_decay value: {}".format(weight_decay))
+        if use_triton and not _HAS_TRITON:
+            raise ImportError("use_triton=True requires triton to be installed")
+        if rms_mode not in _RMS_MODES:
+            raise ValueError("Invalid rms_mode: {}".format(rms_mode))
+        if lookahead_beta is not None and not 0.0 <= lookahead_beta < 1.0:
+            raise ValueError("Invalid lookahead_beta: {}".format(lookahead_beta))
+        if flatten_state and (capturable or not (use_compile or use_triton)):
+            raise ValueError(
+                "flatten_state=True requires capturable=False and "
+                "use_compile=True or use_triton=True"
+            )
         defaults = dict(
             lr=lr,
             betas=betas,
@@ -37,14 +108,68 @@ class SophiaG(Optimizer):
             weight_decay=weight_decay,
             maximize=maximize,
             capturable=capturable,
+            use_compile=use_compile,
+            foreach=foreach,
+            use_triton=use_triton,
+            state_dtype=state_dtype,
+            hessian_dtype=hessian_dtype,
+            rms_mode=rms_mode,
+            lookahead_beta=lookahead_beta,
+            flatten_state=flatten_state,
         )
-        super(SophiaG, self).__init__(params, defaults)
+        super().__init__(params, defaults)
+        self._reset_runtime_buffers()
+
+    def add_param_group(self, param_group):
+        def get(key):
+            return param_group.get(key, self.defaults[key])
+
+        hessian_dtype = get("hessian_dtype")
+        if hessian_dtype is not None and not (
+            hessian_dtype == torch.int8 or hessian_dtype.is_floating_point
+        ):
+            raise ValueError("Invalid hessian_dtype: {}".format(hessian_dtype))
+        if hessian_dtype == torch.int8 and (
+            not get("use_triton") or get("capturable")
+        ):
+            # The other paths dequantize the hessian into a float32 copy, which moves
+            # more memory than a float32 hessian
+            raise ValueError(
+                "hessian_dtype=torch.int8 requires use_triton=True and capturable=False"
+            )
+        super().add_param_group(param_group)
 
     def __setstate__(self, state):
         super().__setstate__(state)
         for group in self.param_groups:
             group.setdefault("maximize", False)
             group.setdefault("capturable", False)
+            group.setdefault("use_compile", False)
+            group.setdefault("foreach", True)
+            group.setdefault("use_triton", False)
+            group.setdefault("state_dtype", None)
+            group.setdefault("hessian_dtype", None)
+            group.setdefault("rms_mode", self.defaults.get("rms_mode", "rms_scale"))
+            group.setdefault("lookahead_beta", self.defaults.get("lookahead_beta"))
+            group.setdefault("flatten_state", False)
+        # The state tensors may have been replaced, and copies and pickles only keep the
+        # state and the groups
+        self._reset_runtime_buffers()
+        # load_state_dict casts the state to the dtype of its parameter, which undoes
+        # the reduced precision state
+        for p, s, state_dtype, hessian_dtype in self._reduced_state_dtypes():
+            if state_dtype is not None and "exp_avg" in s:
+                s["exp_avg"] = s["exp_avg"].to(state_dtype)
+            # A float hessian of a checkpoint without the int8 scale is kept, its values
+            # are not quantized
+            if (
+                hessian_dtype is not None
+                and "hessian" in s
+                and (hessian_dtype != torch.int8 or "hessian_scale" in s)
+            ):
+                s["hessian"] = s["hessian"].to(hessian_dtype)
+            if "hessian_scale" in s:
+                s["hessian_scale"] = s["hessian_scale"].float()
         state_values = list(self.state.values())
         step_is_tensor = (len(state_values) != 0) and torch.is_tensor(
             state_values[0]["step"]
@@ -53,84 +178,553 @@ class SophiaG(Optimizer):
             for s in state_values:
                 s["step"] = torch.tensor(float(s["step"]))
 
-    @torch.no_grad()
-    def update_hessian(self):
+    def _reduced_state_dtypes(self):
+        """Yield ``(p, state, state_dtype, hessian_dtype)`` of the real parameters."""
         for group in self.param_groups:
-            beta1, beta2 = group["betas"]
+            state_dtype = group["state_dtype"]
+            hessian_dtype = group["hessian_dtype"] or state_dtype
+            for p in group["params"]:
+                if p in self.state and not torch.is_complex(p):
+                    yield p, self.state[p], state_dtype, hessian_dtype
+
+    def _reset_runtime_buffers(self):
+        """Reset the caches, buffers and captured graph, none are in ``state_dict``."""
+        self._scratch_buffers = {}
+        self._workspaces = {}
+        self._state_lists = {}
+        self._flat_states = {}
+        self._graph = None
+        self._graph_lrs = None
+        self._graph_hparams = None
+        self._bs_tensors = {}
+        self._lr_tensors = {}
+
+    def _get_state(self, p, group):
+        """Return the (exp_avg, hessian, step, rms) state of ``p``, created if missing.
+
+        rms is None for ``rms_mode="rms_scale"``.
+        """
+        state = self.state[p]
+        # exp_avg and hessian may be kept in reduced precision, complex parameters keep
+        # their dtype
+        state_dtype, hessian_dtype = None, None
+        if not torch.is_complex(p):
+            state_dtype = group["state_dtype"]
+            hessian_dtype = group["hessian_dtype"] or state_dtype
+        if len(state) == 0:
+            state["step"] = (
+                torch.zeros((1,), dtype=torch.float, device=p.device)
+                if self.defaults["capturable"]
+                else torch.tensor(0.0)
+            )
+            state["exp_avg"] = torch.zeros_like(
+                p, memory_format=torch.preserve_format, dtype=state_dtype
+            )
+            _init_hessian(state, p, hessian_dtype)
+        elif "hessian" not in state:
+            _init_hessian(state, p, hessian_dtype)
+        if group["rms_mode"] != "rms_scale" and "rms" not in state:
+            state["rms"] = torch.zeros((1,), dtype=torch.float, device=p.device)
+
+        return state["exp_avg"], state["hessian"], state["step"], state.get("rms")
+
+    def _group_state_lists(self, group, all_params=False):
+        """Return the parameters of ``group`` with a gradient and lists of their state.
+
+        The lists are cached and only rebuilt when the set of parameters with a gradient
+        changes. The gradients themselves are not cached,
+        ``zero_grad(set_to_none=True)`` replaces them. With ``all_params=True`` every
+        parameter of the group is returned and ``.grad`` is not read, these lists have
+        their own cache entry.
+        """
+        grad_mask = (
+            None if all_params else tuple(p.grad is not None for p in group["params"])
+        )
+        cached = self._state_lists.get((id(group), all_params))
+        if cached is not None and cached[0] is group and cached[1] == grad_mask:
+            return cached[2]
+
+        if all_params:
+            params_with_grad = list(group["params"])
+        else:
+            params_with_grad = []
             for p in group["params"]:
                 if p.grad is None:
                     continue
-                state = self.state[p]
+                if p.grad.is_sparse:
+                    raise RuntimeError("Hero does not support sparse gradients")
+                params_with_grad.append(p)
+        if group["flatten_state"]:
+            param_ids = [id(p) for p in params_with_grad]
+            flat = self._flat_states.get(id(group))
+            if flat is None or flat[0] != param_ids:
+                # The new buffers replace the state tensors, which the cached lists of
+                # the other entry still hold
+                self._state_lists.pop((id(group), not all_params), None)
+                # The Triton kernel only runs on CUDA, other groups are stacked like
+                # with use_compile
+                use_triton = group["use_triton"] and all(
+                    p.is_cuda for p in params_with_grad
+                )
+                flatten = (
+                    self._flatten_group_state if use_triton else self._stack_group_state
+                )
+                self._flat_states[id(group)] = (
+                    param_ids,
+                    use_triton,
+                    flatten(group, params_with_grad),
+                )
+
+        exp_avgs = []
+        rmss = []
+        state_steps = []
+        hessian = []
+        hessian_scales = []
+        scratches = []
+        for p in params_with_grad:
+            exp_avg, hess, step_t, rms = self._get_state(p, group)
+            exp_avgs.append(exp_avg)
+            rmss.append(rms)
+            state_steps.append(step_t)
+            hessian.append(hess)
+            hessian_scales.append(self.state[p].get("hessian_scale"))
+            scratches.append(_scratch_buffer(self._scratch_buffers, group, p))
+        if group["rms_mode"] == "rms_scale":
+            rmss = None
+        lookahead_scratches = None
+        if group["lookahead_beta"] is not None and any(
+            scratch is not None for scratch in scratches
+        ):
+            lookahead_scratches = _workspace_views(self._workspaces, exp_avgs)
+
+        # Checked once here instead of for every parameter on every step, real-only
+        # models skip the complex handling
+        has_complex = any(torch.is_complex(p) for p in params_with_grad)
+
+        lists = (
+            params_with_grad,
+            exp_avgs,
+            rmss,
+            state_steps,
+            hessian,
+            hessian_scales,
+            scratches,
+            lookahead_scratches,
+            has_complex,
+        )
+        self._state_lists[(id(group), all_params)] = (group, grad_mask, lists)
+        return lists
+
+    def _flatten_group_state(self, group, params):
+        """Move ``params`` and their state into flat buffers, see ``flatten_state``."""
+        buckets = {}
+        for i, p in enumerate(params):
+            if torch.is_complex(p):
+                raise RuntimeError(
+                    "flatten_state=True does not support complex parameters"
+                )
+            buckets.setdefault((p.device, p.dtype), []).append(i)
+
+        flat_states = []
+        for (device, dtype), indices in buckets.items():
+            bucket = [params[i] for i in indices]
+            for p in bucket:
+                self._get_state(p, group)
+            states = [self.state[p] for p in bucket]
+            numels = [p.numel() for p in bucket]
+            padded = [-(-n // _TRITON_BLOCK_SIZE) * _TRITON_BLOCK_SIZE for n in numels]
+            total = sum(padded)
+
+            flat_param = torch.zeros(total, dtype=dtype, device=device)
+            flat_exp_avg = torch.zeros(
+                total, dtype=states[0]["exp_avg"].dtype, device=device
+            )
+            flat_hess = torch.zeros(
+                total, dtype=states[0]["hessian"].dtype, device=device
+            )
+            flat_rms = torch.zeros(len(bucket), dtype=torch.float, device=device)
+            flat_hess_scale = None
+            if "hessian_scale" in states[0]:
+                flat_hess_scale = torch.zeros(
+                    total // HESSIAN_BLOCK_SIZE, dtype=torch.float, device=device
+                )
+
+            offset = 0
+            grad_pads = []
+            for i, (p, state, n, size) in enumerate(
+                zip(bucket, states, numels, padded)
+            ):
+                param_view = flat_param[offset : offset + n].view_as(p)
+                param_view.copy_(p)
+                p.data = param_view
+                for key, flat in (("exp_avg", flat_exp_avg), ("hessian", flat_hess)):
+                    view = flat[offset : offset + n].view_as(p)
+                    view.copy_(state[key])
+                    state[key] = view
+                if "rms" in state:
+                    flat_rms[i : i + 1].copy_(state["rms"])
+                    state["rms"] = flat_rms[i : i + 1]
+                if flat_hess_scale is not None:
+                    # The blocks of the tensor are those of the buffer at its offset
+                    start = offset // HESSIAN_BLOCK_SIZE
+                    scale_view = flat_hess_scale[
+                        start : start + state["hessian_scale"].numel()
+                    ]
+                    scale_view.copy_(state["hessian_scale"])
+                    state["hessian_scale"] = scale_view
+                grad_pads.append(torch.zeros(size - n, dtype=dtype, device=device))
+                offset += size
+
+            block_tensor = torch.repeat_interleave(
+                torch.arange(len(bucket), dtype=torch.int32),
+                torch.tensor(padded) // _TRITON_BLOCK_SIZE,
+            ).to(device)
+            inv_sqrt_numels = torch.tensor(
+                [n**-0.5 for n in numels], dtype=torch.float, device=device
+            )
+            flat_states.append(
+                _FlatState(
+                    indices=indices,
+                    params=bucket,
+                    grad_pads=grad_pads,
+                    param=flat_param,
+                    grad=torch.zeros(total, dtype=dtype, device=device),
+                    exp_avg=flat_exp_avg,
+                    hess=flat_hess,
+                    rms=flat_rms,
+                    hess_scale=flat_hess_scale,
+                    block_tensor=block_tensor,
+                    inv_sqrt_numels=inv_sqrt_numels,
+                )
+            )
+        return flat_states
+
+    def _stack_group_state(self, group, params):
+        """Move ``params`` and their state into stacks, see ``flatten_state``."""
+        buckets = {}
+        for i, p in enumerate(params):
+            if torch.is_complex(p):
+                raise RuntimeError(
+                    "flatten_state=True does not support complex parameters"
+                )
+            buckets.setdefault((p.device, p.dtype, p.shape), []).append(i)
+
+        stacked_states = []
+        for (device, dtype, shape), indices in buckets.items():
+            bucket = [params[i] for i in indices]
+            for p in bucket:
+                self._get_state(p, group)
+            states = [self.state[p] for p in bucket]
+            # The rms of every tensor, shaped to broadcast against the stacks
+            scalars_shape = (len(bucket),) + (1,) * len(shape)
+
+            stacked_param = torch.stack([p.detach() for p in bucket])
+            stacked_exp_avg = torch.stack([state["exp_avg"] for state in states])
+            stacked_hess = torch.stack([state["hessian"] for state in states])
+            stacked_rms = None
+            if "rms" in states[0]:
+                stacked_rms = torch.stack([state["rms"] for state in states]).view(
+                    scalars_shape
+                )
+            stacked_hess_scale = None
+            if "hessian_scale" in states[0]:
+                stacked_hess_scale = torch.stack(
+                    [state["hessian_scale"] for state in states]
+                )
+
+            for k, (p, state) in enumerate(zip(bucket, states)):
+                p.data = stacked_param[k]
+                state["exp_avg"] = stacked_exp_avg[k]
+                state["hessian"] = stacked_hess[k]
+                if stacked_rms is not None:
+                    state["rms"] = stacked_rms[k].view(1)
+                if stacked_hess_scale is not None:
+                    state["hessian_scale"] = stacked_hess_scale[k]
+
+            stacked_states.append(
+                _StackedState(
+                    indices=indices,
+                    param=stacked_param,
+                    grad=torch.empty_like(stacked_param),
+                    exp_avg=stacked_exp_avg,
+                    hess=stacked_hess,
+                    rms=stacked_rms,
+                    hess_scale=stacked_hess_scale,
+                )
+            )
+        return stacked_states
+
+    def _bs_tensor(self, bs, device):
+        """Return ``bs`` as a persistent one element tensor on ``device``."""
+        cached = self._bs_tensors.get(device)
+        if cached is None or cached[0] != bs:
+            bs_t = (
+                cached[1]
+                if cached is not None
+                else torch.empty((1,), dtype=torch.float, device=device)
+            )
+            cached = self._bs_tensors[device] = (bs, bs_t.fill_(bs))
+        return cached[1]
+
+    def _lr_tensor_pair(self, group, device):
+        """Return ``-lr`` and ``1 - lr * weight_decay`` of ``group`` as 0-d tensors.
+
+        The tensors are kept per (group, device) and only refilled when the values
+        change, so the compiled update gets the learning rate without an allocation and
+        a copy on every step.
+        """
+        key = (id(group), device)
+        values = (group["lr"], group["weight_decay"])
+        cached = self._lr_tensors.get(key)
+        if cached is None:
+            cached = self._lr_tensors[key] = [
+                None,
+                torch.empty((), dtype=torch.float, device=device),
+                torch.empty((), dtype=torch.float, device=device),
+            ]
+        if cached[0] != values:
+            cached[1].fill_(-values[0])
+            cached[2].fill_(1 - values[0] * values[1])
+            cached[0] = values
+        return cached[1], cached[2]
 
-                if len(state) == 0:
-                    state["step"] = (
-                        torch.zeros((1,), dtype=torch.float, device=p.device)
-                        if self.defaults["capturable"]
-                        else torch.tensor(0.0)
-                    )
-                    state["exp_avg"] = torch.zeros_like(
-                        p, memory_format=torch.preserve_format
-                    )
-                    state["hessian"] = torch.zeros_like(
-                        p, memory_format=torch.preserve_format
-                    )
+    @torch.no_grad()
+    def update_hessian(self):
+        for group in self.param_groups:
+            beta1, beta2 = group["betas"]
+            (
+                params_with_grad,
+                _,
+                _,
+                _,
+                hessian,
+                hessian_scales,
+                *_,
+            ) = self._group_state_lists(group)
+            grads = [p.grad for p in params_with_grad]
 
-                if "hessian" not in state.keys():
-                    state["hessian"] = torch.zeros_like(
-                        p, memory_format=torch.preserve_format
-                    )
+            _hessian_ema(
+                hessian,
+                grads,
+                beta2,
+                foreach=group["foreach"],
+                hessian_scales=hessian_scales,
+            )
 
-                state["hessian"].mul_(beta2).addcmul_(p.grad, p.grad, value=1 - beta2)
+    def zero_grad(self, set_to_none: bool = True):
+        # The captured step reads the gradients at the addresses they had during the
+        # capture
+        super().zero_grad(set_to_none=set_to_none and self._graph is None)
 
     @torch.no_grad()
     def step(self, closure=None, bs=5120):
+        if self._graph is None:
+            return self._step_impl(closure, bs=bs)
+
         loss = None
         if closure is not None:
             with torch.enable_grad():
                 loss = closure()
 
+        # LR schedulers assign new values to param_group["lr"], copy them into the
+        # tensors read by the graph
+        for group, lr in zip(self.param_groups, self._graph_lrs):
+            if group["lr"] is not lr:
+                lr.fill_(group["lr"])
+                group["lr"] = lr
+        # The other hyperparameters stay Python numbers in the groups and are only
+        # copied when they change
+        for group, hparams in zip(self.param_groups, self._graph_hparams):
+            values = _graph_hparam_values(group)
+            if values != hparams[0]:
+                hparams[1].copy_(torch.tensor(values, dtype=torch.float))
+                hparams[0] = values
+        self._graph.replay()
+
+        return loss
+
+    @torch.no_grad()
+    def step_with_hessian(
+        self, hessian_grads: List[Optional[Tensor]], closure=None, bs=5120
+    ):
+        """Same as ``update_hessian`` with ``hessian_grads`` then ``step``, in one pass.
+
+        ``hessian_grads`` holds one entry per parameter, in the order of
+        ``self.param_groups``, entries of parameters without a gradient are ignored.
+        With ``use_compile=True`` the hessian EMA is fused into the update kernel.
+        """
+        if self._graph is not None:
+            raise RuntimeError("step_with_hessian cannot be used after capture_step")
+        return self._step_impl(closure, bs=bs, hessian_grads=hessian_grads)
+
+    @torch.no_grad()
+    def step_with_grads(self, grads: List[Tensor], closure=None, bs=5120):
+        """Same as ``step`` with ``grads`` instead of the ``.grad`` of the parameters.
+
+        ``grads`` holds one gradient per parameter, in the order of
+        ``self.param_groups``. Its order is trusted and ``.grad`` is never read, which
+        skips the attribute lookups of ``step``.
+        """
+        if self._graph is not None:
+            raise RuntimeError("step_with_grads cannot be used after capture_step")
+        return self._step_impl(closure, bs=bs, grads=grads)
+
+    def set_lr(self, new_lr):
+        """Set the learning rate of every group, in place for a captured step."""
         for group in self.param_groups:
-            params_with_grad = []
-            grads = []
-            exp_avgs = []
-            state_steps = []
-            hessian = []
-            beta1, beta2 = group["betas"]
+            if torch.is_tensor(group["lr"]):
+                group["lr"].fill_(new_lr)
+            else:
+                group["lr"] = new_lr
 
-            for p in group["params"]:
-                if p.grad is None:
-                    continue
-                params_with_grad.append(p)
+    @torch.no_grad()
+    def capture_step(self, bs=5120):
+        """Capture one optimizer step into a CUDA graph that ``step`` then replays.
+
+        This requires ``capturable=True`` and gradients that already exist and keep
+        their addresses between steps. Once a step is captured, ``zero_grad`` of this
+        optimizer zeroes the gradients in place, also with ``set_to_none=True``, so
+        training loops can stay as they are; nothing else may replace the gradients,
+        e.g. ``model.zero_grad(set_to_none=True)``. Like ``step``, it performs one
+        update. ``bs`` is fixed at capture time. The learning rate of every group
+        becomes a 0-d CUDA tensor, update it in place with
+        ``param_group["lr"].fill_(new_lr)`` or ``set_lr``; plain assignments are copied
+        into that tensor before each replay. ``betas[0]``, ``rho`` and ``weight_decay``
+        are also read from device memory by the graph, so changing them in a group takes
+        effect without a new capture.
+        """
+        if not all(group["capturable"] for group in self.param_groups):
+            raise RuntimeError("capture_step requires capturable=True")
+        for group in self.param_groups:
+            if not torch.is_tensor(group["lr"]):
+                group["lr"] = torch.tensor(
+                    group["lr"], dtype=torch.float, device=group["params"][0].device
+                )
+        self._graph_lrs = [group["lr"] for group in self.param_groups]
+        self._graph_hparams = [
+            [
+                _graph_hparam_values(group),
+                torch.tensor(
+                    _graph_hparam_values(group),
+                    dtype=torch.float,
+                    device=group["lr"].device,
+                ),
+            ]
+            for group in self.param_groups
+        ]
+
+        # Warm up on a side stream before capturing, this also initializes the optimizer
+        # state
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            self._step_impl(bs=bs)
+        torch.cuda.current_stream().wait_stream(stream)
+
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph):
+            self._step_impl(bs=bs)
+        self._graph = graph
+
+    def _step_impl(self, closure=None, bs=5120, hessian_grads=None, grads=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
 
-                if p.grad.is_sparse:
-                    raise RuntimeError("Hero does not support sparse gradients")
-                grads.append(p.grad)
-                state = self.state[p]
-                # State initialization
-                if len(state) == 0:
-                    state["step"] = (
-                        torch.zeros((1,), dtype=torch.float, device=p.device)
-                        if self.defaults["capturable"]
-                        else torch.tensor(0.0)
-                    )
-                    state["exp_avg"] = torch.zeros_like(
-                        p, memory_format=torch.preserve_format
+        all_grads = iter(grads) if grads is not None else None
+        all_hessian_grads = iter(hessian_grads) if hessian_grads is not None else None
+        for i, group in enumerate(self.param_groups):
+            (
+                params_with_grad,
+                exp_avgs,
+                rmss,
+                state_steps,
+                hessian,
+                hessian_scales,
+                scratches,
+                lookahead_scratches,
+                has_complex,
+            ) = self._group_state_lists(group, all_params=all_grads is not None)
+            if all_grads is not None:
+                grads = [next(all_grads) for _ in params_with_grad]
+            else:
+                grads = [p.grad for p in params_with_grad]
+            group_hessian_grads = None
+            if all_hessian_grads is not None:
+                group_hessian_grads = [
+                    hess_grad
+                    for p, hess_grad in zip(group["params"], all_hessian_grads)
+                    if p.grad is not None
+                ]
+            beta1, beta2 = group["betas"]
+            rho, weight_decay = group["rho"], group["weight_decay"]
+            if self._graph_hparams is not None:
+                # 0-d device tensors that a captured step reads on every replay
+                beta1, rho, weight_decay = self._graph_hparams[i][1]
+
+            group_bs = bs
+            if self.defaults["capturable"] and len(params_with_grad) > 0:
+                group_bs = self._bs_tensor(bs, params_with_grad[-1].device)
+
+            # A group without gradients, e.g. a frozen one, has nothing to update
+            if len(params_with_grad) == 0:
+                continue
+
+            if group["flatten_state"]:
+                if group_hessian_grads is not None:
+                    _hessian_ema(
+                        hessian,
+                        group_hessian_grads,
+                        beta2,
+                        foreach=True,
+                        hessian_scales=hessian_scales,
                     )
-                    state["hessian"] = torch.zeros_like(
-                        p, memory_format=torch.preserve_format
+                _, use_triton, flat_states = self._flat_states[id(group)]
+                if use_triton:
+                    _flat_triton_sophiag(
+                        flat_states,
+                        grads,
+                        state_steps,
+                        bs=group_bs,
+                        beta1=beta1,
+                        rho=rho,
+                        lr=group["lr"],
+                        weight_decay=weight_decay,
+                        maximize=group["maximize"],
+                        rms_mode=group["rms_mode"],
+                        lookahead_beta=group["lookahead_beta"],
                     )
-
-                if "hessian" not in state.keys():
-                    state["hessian"] = torch.zeros_like(
-                        p, memory_format=torch.preserve_format
+                else:
+                    lr_tensors = None
+                    if group["use_compile"]:
+                        lr_tensors = {
+                            stacked.param.device: self._lr_tensor_pair(
+                                group, stacked.param.device
+                            )
+                            for stacked in flat_states
+                        }
+                    _stacked_sophiag(
+                        flat_states,
+                        grads,
+                        state_steps,
+                        bs=group_bs,
+                        beta1=beta1,
+                        rho=rho,
+                        lr=group["lr"],
+                        weight_decay=weight_decay,
+                        maximize=group["maximize"],
+                        rms_mode=group["rms_mode"],
+                        lookahead_beta=group["lookahead_beta"],
+                        use_compile=group["use_compile"],
+                        lr_tensors=lr_tensors,
                     )
+                continue
 
-                exp_avgs.append(state["exp_avg"])
-                state_steps.append(state["step"])
-                hessian.append(state["hessian"])
-
-                if self.defaults["capturable"]:
-                    bs = torch.ones((1,), dtype=torch.float, device=p.device) * bs
+            lr_tensors = None
+            if group["use_compile"] and not group["capturable"]:
+                device = params_with_grad[0].device
+                lr_tensors = {device: self._lr_tensor_pair(group, device)}
 
             sophiag(
                 params_with_grad,
@@ -138,19 +732,83 @@ class SophiaG(Optimizer):
                 exp_avgs,
                 hessian,
                 state_steps,
-                bs=bs,
+                bs=group_bs,
                 beta1=beta1,
                 beta2=beta2,
-                rho=group["rho"],
+                rho=rho,
                 lr=group["lr"],
-                weight_decay=group["weight_decay"],
+                weight_decay=weight_decay,
                 maximize=group["maximize"],
                 capturable=group["capturable"],
+                use_compile=group["use_compile"],
+                foreach=group["foreach"],
+                use_triton=group["use_triton"],
+                rmss=rmss,
+                rms_mode=group["rms_mode"],
+                lookahead_beta=group["lookahead_beta"],
+                hessian_grads=group_hessian_grads,
+                hessian_scales=hessian_scales,
+                scratches=scratches,
+                lookahead_scratches=lookahead_scratches,
+                has_complex=has_complex,
+                lr_tensors=lr_tensors,
             )
 
         return loss
 
 
+class SophiaG_RMS(SophiaG):
+    """SophiaG with ``rms_mode="clamp_rms"``."""
+
+    def __init__(
+        self,
+        params,
+        lr=1e-4,
+        betas=(0.965, 0.99),
+        rho=0.04,
+        weight_decay=1e-1,
+        **kwargs
+    ):
+        super().__init__(
+            params, lr, betas, rho, weight_decay, rms_mode="clamp_rms", **kwargs
+        )
+
+
+class SophiaG_OG(SophiaG):
+    """SophiaG with ``rms_mode="none"``."""
+
+    def __init__(
+        self,
+        params,
+        lr=1e-4,
+        betas=(0.965, 0.99),
+        rho=0.04,
+        weight_decay=1e-1,
+        **kwargs
+    ):
+        super().__init__(
+            params, lr, betas, rho, weight_decay, rms_mode="none", **kwargs
+        )
+
+
+class SophiaG_RMSD(SophiaG):
+    """SophiaG with ``rms_mode="clamp_rms"`` and ``lookahead_beta=0.95``."""
+
+    def __init__(
+        self, params, lr=1e-4, betas=(0.99, 0.99), rho=0.04, weight_decay=1e-1, **kwargs
+    ):
+        super().__init__(
+            params,
+            lr,
+            betas,
+            rho,
+            weight_decay,
+            rms_mode="clamp_rms",
+            lookahead_beta=0.95,
+            **kwargs,
+        )
+
+
 def sophiag(
     params: List[Tensor],
     grads: List[Tensor],
@@ -165,20 +823,61 @@ def sophiag(
     rho: float,
     lr: float,
     weight_decay: float,
-    maximize: bool
+    maximize: bool,
+    use_compile: bool = False,
+    foreach: bool = True,
+    use_triton: bool = False,
+    rmss: Optional[List[Tensor]] = None,
+    rms_mode: str = "rms_scale",
+    lookahead_beta: Optional[float] = None,
+    hessian_grads: Optional[List[Tensor]] = None,
+    hessian_scales: Optional[List[Optional[Tensor]]] = None,
+    scratches: Optional[List[Optional[Tensor]]] = None,
+    lookahead_scratches: Optional[List[Tensor]] = None,
+    has_complex: bool = True,
+    lr_tensors: Optional[Dict[torch.device, Tuple[Tensor, Tensor]]] = None
 ):
-
     if not all(isinstance(t, torch.Tensor) for t in state_steps):
         raise RuntimeError(
             "API has changed, `state_steps` argument must contain a list of singleton tensors"
         )
 
+    if _takes_foreach_update(foreach, capturable, use_triton, use_compile):
+        if hessian_grads is not None:
+            _hessian_ema(
+                hessian,
+                hessian_grads,
+                beta2,
+                foreach=True,
+                hessian_scales=hessian_scales,
+            )
+        _multi_tensor_sophiag(
+            params,
+            grads,
+            exp_avgs,
+            rmss,
+            hessian,
+            state_steps,
+            bs=bs,
+            beta1=beta1,
+            beta2=beta2,
+            rho=rho,
+            lr=lr,
+            weight_decay=weight_decay,
+            maximize=maximize,
+            hessian_scales=hessian_scales,
+            rms_mode=rms_mode,
+            lookahead_beta=lookahead_beta,
+        )
+        return
+
     func = _single_tensor_sophiag
 
     func(
         params,
         grads,
         exp_avgs,
+        rmss,
         hessian,
         state_steps,
         bs=bs,
@@ -189,17 +888,710 @@ def sophiag(
         weight_decay=weight_decay,
         maximize=maximize,
         capturable=capturable,
+        use_compile=use_compile,
+        use_triton=use_triton,
+        rms_mode=rms_mode,
+        lookahead_beta=lookahead_beta,
+        hessian_grads=hessian_grads,
+        hessian_scales=hessian_scales,
+        scratches=scratches,
+        lookahead_scratches=lookahead_scratches,
+        has_complex=has_complex,
+        lr_tensors=lr_tensors,
+    )
+
+
+def sophiag_rms(
+    params, grads, exp_avgs, rmss, hessian, state_steps, capturable=False, **kwargs
+):
+    sophiag(
+        params,
+        grads,
+        exp_avgs,
+        hessian,
+        state_steps,
+        capturable,
+        rmss=rmss,
+        rms_mode="clamp_rms",
+        **kwargs,
+    )
+
+
+def sophiag_og(
+    params, grads, exp_avgs, rmss, hessian, state_steps, capturable=False, **kwargs
+):
+    sophiag(
+        params,
+        grads,
+        exp_avgs,
+        hessian,
+        state_steps,
+        capturable,
+        rmss=rmss,
+        rms_mode="none",
+        **kwargs,
+    )
+
+
+def sophiag_rmsd(
+    params, grads, exp_avgs, rmss, hessian, state_steps, capturable=False, **kwargs
+):
+    sophiag(
+        params,
+        grads,
+        exp_avgs,
+        hessian,
+        state_steps,
+        capturable,
+        rmss=rmss,
+        rms_mode="clamp_rms",
+        lookahead_beta=0.95,
+        **kwargs,
     )
 
 
-def _rms(tensor):
+def _graph_hparam_values(group):
+    """The hyperparameters besides ``lr`` that ``capture_step`` keeps on device."""
+    return [group["betas"][0], group["rho"], group["weight_decay"]]
+
+
+def _skips_weight_decay(weight_decay) -> bool:
+    """Whether the weight decay pass is skipped, never for a captured step."""
+    return not torch.is_tensor(weight_decay) and weight_decay == 0
+
+
+def _rms(tensor, stacked: bool = False):
+    if stacked:
+        # One RMS per tensor of a stack, shaped to broadcast against it
+        norms = (
+            tensor.reshape(tensor.shape[0], -1)
+            .norm(2, dim=1)
+            .view((-1,) + (1,) * (tensor.dim() - 1))
+        )
+        return norms / (tensor[0].numel() ** 0.5)
     return tensor.norm(2) / (tensor.numel() ** 0.5)
 
 
+def _batched_rms(tensors: List[Tensor]) -> List[Tensor]:
+    """Return ``_rms`` of every tensor, with one norm kernel for all of them."""
+    norms = list(torch._foreach_norm(tensors))
+    torch._foreach_div_(norms, [t.numel() ** 0.5 for t in tensors])
+    return norms
+
+
+def _init_hessian(state, p: Tensor, dtype: Optional[torch.dtype]):
+    state["hessian"] = torch.zeros_like(
+        p, memory_format=torch.preserve_format, dtype=dtype
+    )
+    if dtype == torch.int8:
+        # One scale per block of the flattened hessian, see dequantize_hessian
+        num_blocks = -(-p.numel() // HESSIAN_BLOCK_SIZE)
+        state["hessian_scale"] = torch.zeros(
+            num_blocks, dtype=torch.float, device=p.device
+        )
+
+
+def _hessian_blocks(t: Tensor, rows: int = 1) -> Tensor:
+    """Return a float copy of ``t`` as (rows, blocks, ``HESSIAN_BLOCK_SIZE``).
+
+    Every row is a flattened tensor, zero padded to whole blocks.
+    """
+    t = t.reshape(rows, -1).float()
+    padding = -t.shape[1] % HESSIAN_BLOCK_SIZE
+    return torch.nn.functional.pad(t, (0, padding)).view(rows, -1, HESSIAN_BLOCK_SIZE)
+
+
+def dequantize_hessian(hess: Tensor, scale: Tensor, rows: int = 1) -> Tensor:
+    """Return the float32 hessian of an int8 ``hess`` and its blockwise ``scale``.
+
+    The codes are ``round(127 * sqrt(hessian / scale))``, with the max of its block of
+    ``HESSIAN_BLOCK_SIZE`` elements as ``scale``. The levels are finer at small
+    curvature, and an element only rounds to 0 below ``scale / 127**2``. With ``rows``
+    the leading dim of ``hess`` is a stack of tensors, each with its own scales.
+    """
+    blocks = _hessian_blocks(hess, rows).div_(127).square_()
+    blocks.mul_(scale.view(rows, -1, 1))
+    return blocks.view(rows, -1)[:, : hess.numel() // rows].reshape(hess.shape)
+
+
+def _int8_hessian_ema(hess: Tensor, grad: Tensor, scale: Tensor, beta2: float):
+    """Hessian EMA of an int8 hessian, requantized with new blockwise scales."""
+    if _HAS_TRITON and hess.is_cuda and hess.is_contiguous() and grad.is_contiguous():
+        _triton_int8_hessian_ema(
+            hess, grad, scale, beta2=beta2, hess_block_size=HESSIAN_BLOCK_SIZE
+        )
+        return
+    # Reference for the tensors the kernel does not take, through a float copy
+    grad = grad.float()
+    new_hess = dequantize_hessian(hess, scale).mul_(beta2)
+    new_hess.addcmul_(grad, grad, value=1 - beta2)
+    blocks = _hessian_blocks(new_hess)
+    # The hessian is non-negative, so the max of a block is its absmax
+    scale.copy_(blocks.amax(dim=2).clamp_(min=torch.finfo(torch.float).tiny).view(-1))
+    codes = blocks.div_(scale.view(1, -1, 1)).sqrt_().mul_(127).round_()
+    hess.copy_(codes.view(-1)[: hess.numel()].view_as(hess))
+
+
+def _takes_foreach_update(
+    foreach: bool, capturable: bool, use_triton: bool, use_compile: bool
+) -> bool:
+    """Whether ``sophiag`` runs the update of a group with ``_multi_tensor_sophiag``."""
+    return foreach and not capturable and not use_triton and not use_compile
+
+
+def _takes_triton_update(use_triton: bool, capturable: bool, p: Tensor) -> bool:
+    """Whether ``_single_tensor_sophiag`` updates ``p`` with the Triton kernel."""
+    return use_triton and not capturable and p.is_cuda
+
+
+def _scratch_buffer(buffers, group, p: Tensor) -> Optional[Tensor]:
+    """Return the persistent ratio buffer of ``p`` for the eager update, else None.
+
+    The buffers are kept out of the optimizer state, so that they are not saved in
+    checkpoints.
+    """
+    # Flattened groups only take the flat and stacked updates
+    if group["flatten_state"]:
+        return None
+    if _takes_foreach_update(
+        group["foreach"], group["capturable"], group["use_triton"], group["use_compile"]
+    ):
+        return None
+    if _takes_triton_update(group["use_triton"], group["capturable"], p):
+        return None
+    if group["use_compile"] and not group["capturable"]:
+        return None
+    if p not in buffers:
+        buffers[p] = torch.empty_like(p, memory_format=torch.preserve_format)
+    return buffers[p]
+
+
+def _workspace_views(workspaces, tensors: List[Tensor]) -> List[Tensor]:
+    """Return views shaped like ``tensors`` of one workspace per (device, dtype).
+
+    The eager update handles one parameter after the other on the same stream, so every
+    parameter can use the same memory for its temporary.
+    """
+    numels = {}
+    for t in tensors:
+        key = (t.device, t.dtype)
+        numels[key] = max(numels.get(key, 0), t.numel())
+    for key, numel in numels.items():
+        if key not in workspaces or workspaces[key].numel() < numel:
+            workspaces[key] = torch.empty(numel, dtype=key[1], device=key[0])
+    return [workspaces[(t.device, t.dtype)][: t.numel()].view(t.shape) for t in tensors]
+
+
+class _FlatState(NamedTuple):
+    """Flat buffers of the parameters of one (device, dtype) of a flattened group."""
+
+    indices: List[int]
+    params: List[Tensor]
+    grad_pads: List[Tensor]
+    param: Tensor
+    grad: Tensor
+    exp_avg: Tensor
+    hess: Tensor
+    rms: Tensor
+    hess_scale: Optional[Tensor]
+    block_tensor: Tensor
+    inv_sqrt_numels: Tensor
+
+
+class _StackedState(NamedTuple):
+    """Stacks of the parameters of one (device, dtype, shape) of a flattened group."""
+
+    indices: List[int]
+    param: Tensor
+    grad: Tensor
+    exp_avg: Tensor
+    hess: Tensor
+    rms: Optional[Tensor]
+    hess_scale: Optional[Tensor]
+
+
+def _hessian_ema(
+    hessian: List[Tensor],
+    grads: List[Tensor],
+    beta2: float,
+    foreach: bool,
+    hessian_scales: Optional[List[Optional[Tensor]]] = None,
+):
+    """Update ``hess = beta2 * hess + (1 - beta2) * grad * grad`` for every tensor."""
+    if hessian_scales is not None and any(
+        scale is not None for scale in hessian_scales
+    ):
+        float_hessian, float_grads = [], []
+        for hess, grad, scale in zip(hessian, grads, hessian_scales):
+            if scale is None:
+                float_hessian.append(hess)
+                float_grads.append(grad)
+            else:
+                _int8_hessian_ema(hess, grad, scale, beta2)
+        hessian, grads = float_hessian, float_grads
+    if len(hessian) == 0:
+        return
+    one_minus_beta2 = 1 - beta2
+    grads = [grad.to(hess.dtype) for hess, grad in zip(hessian, grads)]
+    if foreach:
+        torch._foreach_mul_(hessian, beta2)
+        torch._foreach_addcmul_(hessian, grads, grads, value=one_minus_beta2)
+    else:
+        for hess, grad in zip(hessian, grads):
+            hess.mul_(beta2).addcmul_(grad, grad, value=one_minus_beta2)
+
+
+def _sophiag_update(
+    param: Tensor,
+    grad: Tensor,
+    exp_avg: Tensor,
+    hess: Tensor,
+    rms: Optional[Tensor],
+    neg_lr,
+    one_minus_wd: Optional[Tensor],
+    beta1: float,
+    one_minus_beta1: float,
+    rho_bs,
+    rms_mode: str,
+    hess_grad: Optional[Tensor] = None,
+    beta2: float = 0.0,
+    scratch: Optional[Tensor] = None,
+    lookahead_beta: Optional[float] = None,
+    lookahead_scratch: Optional[Tensor] = None,
+    maximize: bool = False,
+    stacked: bool = False,
+):
+    if hess_grad is not None:
+        # Hessian EMA fused into the update, under torch.compile the new hessian is
+        # consumed without a re-read
+        hess_grad = hess_grad.to(hess.dtype)
+        hess.mul_(beta2).addcmul_(hess_grad, hess_grad, value=1 - beta2)
+
+    # Perform stepweight decay, None without weight decay, which saves a pass over the
+    # parameter
+    if one_minus_wd is not None:
+        param.mul_(one_minus_wd)
+
+    # Decay the first and second moment running average coefficient, in the dtype of the
+    # state
+    # maximize negates the gradient through the coefficients it is multiplied with,
+    # instead of a negated copy
+    grad = grad.to(exp_avg.dtype)
+    if maximize:
+        one_minus_beta1 = -one_minus_beta1
+    momentum = exp_avg
+    if lookahead_beta is not None:
+        # The ratio uses a look-ahead of the first moment, taken before its update
+        if lookahead_scratch is None:
+            momentum = exp_avg.mul(lookahead_beta)
+        else:
+            momentum = torch.mul(exp_avg, lookahead_beta, out=lookahead_scratch)
+        momentum.add_(
+            grad, alpha=lookahead_beta - 1 if maximize else 1 - lookahead_beta
+        )
+    if torch.is_tensor(one_minus_beta1):
+        # Device tensor of a captured step, which alpha does not accept
+        exp_avg.mul_(beta1).addcmul_(grad, one_minus_beta1)
+    else:
+        exp_avg.mul_(beta1).add_(grad, alpha=one_minus_beta1)
+
+    # Adafactor RMS, kept on device so that no host sync is needed
+    if rms_mode == "rms_scale":
+        step_size_neg = torch.clamp(_rms(param, stacked), min=1e-3) * neg_lr
+        max_ratio = 1
+    else:
+        step_size_rel = torch.clamp(_rms(param, stacked), min=1e-5)
+        rms.copy_(step_size_rel)
+        step_size_neg = neg_lr
+        max_ratio = step_size_rel if rms_mode == "clamp_rms" else 1
+
+    # sign(m) * clamp(|m| / d, max=c) == clamp(m / d, -c, c), which saves the abs and
+    # sign temporaries
+    # The ratio is taken in the dtype of the parameter, also for reduced precision state
+    # The denominator, ratio and clamp share one buffer, the persistent one if given so
+    # that the step allocates nothing
+    if scratch is None:
+        ratio = (rho_bs * hess.to(param.dtype)).add_(1e-15)
+    else:
+        ratio = torch.mul(hess, rho_bs, out=scratch).add_(1e-15)
+    torch.div(momentum, ratio, out=ratio)
+    ratio.clamp_(min=-max_ratio, max=max_ratio)
+    param.add_(ratio.mul_(step_size_neg))
+
+
+_compiled_sophiag_update = None
+
+
+def _get_sophiag_update(use_compile: bool):
+    """Return the per-tensor update, compiled into one fused kernel when requested.
+
+    Compilation is deferred to the first step so that importing this module does not
+    require torch.compile support. Dynamo keeps one cache for the code of
+    ``_sophiag_update``, shared by every optimizer, group and shape. The shapes are
+    therefore left to the automatic dynamic shapes, and the graph is not required to be
+    whole, so that a full cache falls back to the eager update instead of raising.
+    """
+    global _compiled_sophiag_update
+    if not use_compile:
+        return _sophiag_update
+    if _compiled_sophiag_update is None:
+        _compiled_sophiag_update = torch.compile(_sophiag_update, dynamic=None)
+    return _compiled_sophiag_update
+
+
+def _triton_sophiag_update(
+    param: Tensor,
+    grad: Tensor,
+    exp_avg: Tensor,
+    hess: Tensor,
+    rms: Optional[Tensor],
+    lr: float,
+    one_minus_wd: float,
+    beta1: float,
+    rho_bs: float,
+    rms_mode: str,
+    hess_scale: Optional[Tensor] = None,
+    maximize: bool = False,
+    lookahead_beta: Optional[float] = None,
+):
+    """Same update as ``_sophiag_update``, in one pass by a Triton kernel."""
+    if not all(t.is_contiguous() for t in (param, grad, exp_avg, hess)):
+        if hess_scale is not None:
+            hess = dequantize_hessian(hess, hess_scale)
+        if one_minus_wd == 1:
+            one_minus_wd = None
+        return _sophiag_update(
+            param,
+            grad,
+            exp_avg,
+            hess,
+            rms,
+            -lr,
+            one_minus_wd,
+            beta1,
+            1 - beta1,
+            rho_bs,
+            rms_mode,
+            lookahead_beta=lookahead_beta,
+            maximize=maximize,
+        )
+
+    # The RMS is a reduction, so it is taken before the kernel, on the parameter after
+    # weight decay
+    param_rms = _rms(param) * one_minus_wd
+    if rms_mode == "rms_scale":
+        param_rms.clamp_(min=1e-3)
+    else:
+        param_rms.clamp_(min=1e-5)
+        rms.copy_(param_rms)
+
+    _triton_sophia_update(
+        param.view(-1),
+        grad.view(-1),
+        exp_avg.view(-1),
+        hess.view(-1),
+        param_rms,
+        hess_scale,
+        hess_block_size=HESSIAN_BLOCK_SIZE,
+        decay=one_minus_wd,
+        beta1=beta1,
+        rho_bs=rho_bs,
+        neg_lr=-lr,
+        clamp_by_rms=rms_mode == "clamp_rms",
+        scale_by_rms=rms_mode == "rms_scale",
+        maximize=maximize,
+        lookahead_beta=lookahead_beta,
+    )
+
+
+def _flat_triton_sophiag(
+    flat_states: List[_FlatState],
+    grads: List[Tensor],
+    state_steps: List[Tensor],
+    *,
+    bs: int,
+    beta1: float,
+    rho: float,
+    lr: float,
+    weight_decay: float,
+    maximize: bool,
+    rms_mode: str,
+    lookahead_beta: Optional[float] = None
+):
+    """Same update as ``_triton_sophiag_update``, one launch per flat buffer."""
+    torch._foreach_add_(state_steps, 1)
+    one_minus_wd = 1 - lr * weight_decay
+
+    for flat in flat_states:
+        # A single copy of all the gradients, the padding stays zero so that the padded
+        # elements are not updated
+        grad_pieces = []
+        for i, pad in zip(flat.indices, flat.grad_pads):
+            grad_pieces.append(grads[i].reshape(-1))
+            grad_pieces.append(pad)
+        torch.cat(grad_pieces, out=flat.grad)
+
+        # The RMS of every parameter after weight decay, read by the kernel through the
+        # index of the block
+        param_rms = (
+            torch.stack(torch._foreach_norm(flat.params))
+            .mul_(flat.inv_sqrt_numels)
+            .mul_(one_minus_wd)
+        )
+        if rms_mode == "rms_scale":
+            param_rms.clamp_(min=1e-3)
+        else:
+            param_rms.clamp_(min=1e-5)
+            flat.rms.copy_(param_rms)
+
+        _triton_sophia_update(
+            flat.param,
+            flat.grad,
+            flat.exp_avg,
+            flat.hess,
+            param_rms,
+            flat.hess_scale,
+            flat.block_tensor,
+            hess_block_size=HESSIAN_BLOCK_SIZE,
+            decay=one_minus_wd,
+            beta1=beta1,
+            rho_bs=rho * bs,
+            neg_lr=-lr,
+            clamp_by_rms=rms_mode == "clamp_rms",
+            scale_by_rms=rms_mode == "rms_scale",
+            maximize=maximize,
+            lookahead_beta=lookahead_beta,
+        )
+
+
+def _stacked_sophiag(
+    stacked_states: List[_StackedState],
+    grads: List[Tensor],
+    state_steps: List[Tensor],
+    *,
+    bs: int,
+    beta1: float,
+    rho: float,
+    lr: float,
+    weight_decay: float,
+    maximize: bool,
+    rms_mode: str,
+    lookahead_beta: Optional[float] = None,
+    use_compile: bool = True,
+    lr_tensors: Optional[Dict[torch.device, Tuple[Tensor, Tensor]]] = None
+):
+    """Same update as ``_sophiag_update``, with one call per stack of parameters.
+
+    The ``"rms_scale"`` update of the stacks is run eagerly, Inductor fails to compile
+    its RMS scaled step on some torch versions. ``lr_tensors`` holds the ``-lr`` and
+    ``1 - lr * weight_decay`` tensors of the compiled update per device, see
+    ``SophiaG._lr_tensor_pair``.
+    """
+    torch._foreach_add_(state_steps, 1)
+    use_compile = use_compile and rms_mode != "rms_scale"
+    update_fn = _get_sophiag_update(use_compile)
+    skip_weight_decay = _skips_weight_decay(weight_decay)
+
+    if not use_compile:
+        lr_tensors = None
+    elif lr_tensors is None:
+        lr_tensors = {}
+    for stacked in stacked_states:
+        torch.stack([grads[i] for i in stacked.indices], out=stacked.grad)
+
+        hess = stacked.hess
+        if stacked.hess_scale is not None:
+            hess = dequantize_hessian(
+                hess, stacked.hess_scale, rows=len(stacked.indices)
+            )
+
+        neg_lr, one_minus_wd = -lr, 1 - lr * weight_decay
+        if lr_tensors is not None:
+            device = stacked.param.device
+            if device not in lr_tensors:
+                # The learning rate changes every step, pass it as a tensor so the
+                # compiled update is not re-specialized on it
+                lr_t = torch.tensor(lr, device=device)
+                lr_tensors[device] = (-lr_t, 1 - lr_t * weight_decay)
+            neg_lr, one_minus_wd = lr_tensors[device]
+        update_fn(
+            stacked.param,
+            stacked.grad,
+            stacked.exp_avg,
+            hess,
+            stacked.rms,
+            neg_lr=neg_lr,
+            one_minus_wd=None if skip_weight_decay else one_minus_wd,
+            beta1=beta1,
+            one_minus_beta1=1 - beta1,
+            rho_bs=rho * bs,
+            rms_mode=rms_mode,
+            lookahead_beta=lookahead_beta,
+            maximize=maximize,
+            stacked=True,
+        )
+
+
+def _multi_tensor_sophiag(
+    params: List[Tensor],
+    grads: List[Tensor],
+    exp_avgs: List[Tensor],
+    rmss: Optional[List[Tensor]],
+    hessian: List[Tensor],
+    state_steps: List[Tensor],
+    *,
+    bs: int,
+    beta1: float,
+    beta2: float,
+    rho: float,
+    lr: float,
+    weight_decay: float,
+    maximize: bool,
+    rms_mode: str,
+    hessian_scales: Optional[List[Optional[Tensor]]] = None,
+    lookahead_beta: Optional[float] = None
+):
+    """Same update as ``_sophiag_update``, with foreach ops per (device, dtype) group.
+
+    The int8 hessian is dequantized tensor by tensor. The ops that pair the tensors with
+    their 0-d per-tensor scalars, i.e. the clamp to the RMS and the RMS scaled step,
+    take the foreach fallback that loops over the tensors. The scalars stay on the
+    device so that the step needs no host sync.
+    """
+    if len(params) == 0:
+        return
+
+    no_tensors = [None] * len(params)
+    tensorlists = [
+        params,
+        grads,
+        exp_avgs,
+        hessian,
+        state_steps,
+        hessian_scales if hessian_scales is not None else no_tensors,
+        rmss if rmss is not None else no_tensors,
+    ]
+    one_minus_wd = 1 - lr * weight_decay
+    skip_weight_decay = _skips_weight_decay(weight_decay)
+    grad_alpha = beta1 - 1 if maximize else 1 - beta1
+    if lookahead_beta is not None:
+        lookahead_alpha = lookahead_beta - 1 if maximize else 1 - lookahead_beta
+    rho_bs = rho * bs
+
+    for device_tensors in _group_by_device_and_dtype(tensorlists).values():
+        (
+            device_params,
+            device_grads,
+            device_exp_avgs,
+            device_hessian,
+            device_state_steps,
+        ) = device_tensors[:5]
+        device_hessian_scales, device_rmss = device_tensors[5:]
+
+        # Handle complex parameters, the groups are split by dtype so a group is either
+        # all complex or all real
+        if torch.is_complex(device_params[0]):
+            device_params = [torch.view_as_real(x) for x in device_params]
+            device_grads = [torch.view_as_real(x) for x in device_grads]
+            device_exp_avgs = [torch.view_as_real(x) for x in device_exp_avgs]
+            device_hessian = [torch.view_as_real(x) for x in device_hessian]
+
+        # foreach ops need matching dtypes, reduced precision state is updated in its
+        # own dtype
+        reduced_state = device_exp_avgs[0].dtype != device_params[0].dtype
+        if reduced_state:
+            device_grads = [
+                g.to(e.dtype) for g, e in zip(device_grads, device_exp_avgs)
+            ]
+
+        # update step
+        torch._foreach_add_(device_state_steps, 1)
+
+        # Perform stepweight decay
+        if not skip_weight_decay:
+            torch._foreach_mul_(device_params, one_minus_wd)
+
+        # Decay the first and second moment running average coefficient
+        momentum = device_exp_avgs
+        if lookahead_beta is not None:
+            momentum = torch._foreach_mul(device_exp_avgs, lookahead_beta)
+            torch._foreach_add_(momentum, device_grads, alpha=lookahead_alpha)
+        torch._foreach_mul_(device_exp_avgs, beta1)
+        torch._foreach_add_(device_exp_avgs, device_grads, alpha=grad_alpha)
+
+        if device_hessian[0].dtype != device_params[0].dtype:
+            if device_hessian_scales[0] is not None:
+                # Complex parameters are in their own group and never quantized
+                device_hessian = [
+                    dequantize_hessian(h, scale)
+                    for h, scale in zip(device_hessian, device_hessian_scales)
+                ]
+            # The ratio is taken in the dtype of the parameters
+            denom = [h.to(p.dtype) for h, p in zip(device_hessian, device_params)]
+            torch._foreach_mul_(denom, rho_bs)
+        else:
+            denom = torch._foreach_mul(device_hessian, rho_bs)
+        torch._foreach_add_(denom, 1e-15)
+
+        # Adafactor RMS
+        param_rms = _batched_rms(device_params)
+        if rms_mode == "rms_scale":
+            torch._foreach_clamp_min_(param_rms, 1e-3)
+            step_sizes_neg = torch._foreach_mul(param_rms, -lr)
+        else:
+            torch._foreach_clamp_min_(param_rms, 1e-5)
+            # 0-d views, so that the state and the norms have matching shapes for a
+            # single foreach launch
+            device_rmss = [r.view(()) for r in device_rmss]
+            torch._foreach_zero_(device_rmss)
+            torch._foreach_add_(device_rmss, param_rms)
+            if rms_mode == "clamp_rms":
+                # clamp(m / d, -r, r) == r * clamp(m / (r * d), -1, 1), which keeps the
+                # clamp bounds scalar
+                torch._foreach_mul_(denom, param_rms)
+                step_sizes_neg = torch._foreach_mul(param_rms, -lr)
+            else:
+                step_sizes_neg = None
+
+        # Signed ratio, as in _sophiag_update
+        if reduced_state:
+            ratio = [m.to(p.dtype) for m, p in zip(momentum, device_params)]
+            torch._foreach_div_(ratio, denom)
+        elif lookahead_beta is not None:
+            # The look-ahead is a temporary, the ratio reuses it
+            ratio = momentum
+            torch._foreach_div_(ratio, denom)
+        else:
+            ratio = torch._foreach_div(device_exp_avgs, denom)
+        torch._foreach_clamp_min_(ratio, -1.0)
+        torch._foreach_clamp_max_(ratio, 1.0)
+        if step_sizes_neg is None:
+            torch._foreach_add_(device_params, ratio, alpha=-lr)
+        else:
+            torch._foreach_addcmul_(device_params, ratio, step_sizes_neg)
+
+
+def _group_by_device_and_dtype(tensorlists: List[List[Optional[Tensor]]]):
+    """Split ``tensorlists`` by the (device, dtype) of the tensors of the first list.
+
+    Returns a dict of the lists of every (device, dtype), in the order of
+    ``tensorlists``. The private grouping helper of torch changed its return type
+    between versions, so the grouping is done here.
+    """
+    indices = {}
+    for i, t in enumerate(tensorlists[0]):
+        indices.setdefault((t.device, t.dtype), []).append(i)
+    return {
+        key: [[tensors[i] for i in key_indices] for tensors in tensorlists]
+        for key, key_indices in indices.items()
+    }
+
+
 def _single_tensor_sophiag(
     params: List[Tensor],
     grads: List[Tensor],
     exp_avgs: List[Tensor],
+    rmss: Optional[List[Tensor]],
     hessian: List[Tensor],
     state_steps: List[Tensor],
     *,
@@ -210,812 +1602,117 @@ def _single_tensor_sophiag(
     lr: float,
     weight_decay: float,
     maximize: bool,
-    capturable: bool
+    capturable: bool,
+    use_compile: bool,
+    use_triton: bool,
+    rms_mode: str,
+    lookahead_beta: Optional[float] = None,
+    hessian_grads: Optional[List[Tensor]] = None,
+    hessian_scales: Optional[List[Optional[Tensor]]] = None,
+    scratches: Optional[List[Optional[Tensor]]] = None,
+    lookahead_scratches: Optional[List[Tensor]] = None,
+    has_complex: bool = True,
+    lr_tensors: Optional[Dict[torch.device, Tuple[Tensor, Tensor]]] = None
 ):
+    # Loop invariant scalars, computed once for all parameters, with capturable=True
+    # they are device tensors
+    one_minus_wd = 1 - lr * weight_decay
+    one_minus_beta1 = 1 - beta1
+    rho_bs = rho * bs
+
+    update_fn = _get_sophiag_update(use_compile and not capturable)
+    update_neg_lr, update_one_minus_wd = -lr, one_minus_wd
+    if use_compile and not capturable and len(params) > 0:
+        # The learning rate changes every step, pass it as a tensor so the compiled
+        # update is not re-specialized on it
+        device = params[0].device
+        if lr_tensors is not None and device in lr_tensors:
+            update_neg_lr, update_one_minus_wd = lr_tensors[device]
+        else:
+            update_lr = torch.tensor(lr, device=device)
+            update_neg_lr = -update_lr
+            update_one_minus_wd = 1 - update_lr * weight_decay
+    if _skips_weight_decay(weight_decay):
+        update_one_minus_wd = None
 
     for i, param in enumerate(params):
-        grad = grads[i] if not maximize else -grads[i]
+        grad = grads[i]
         exp_avg = exp_avgs[i]
+        rms = rmss[i] if rmss is not None else None
         hess = hessian[i]
         step_t = state_steps[i]
+        scratch = scratches[i] if scratches is not None else None
+        lookahead_scratch = (
+            lookahead_scratches[i] if lookahead_scratches is not None else None
+        )
+        hess_grad = hessian_grads[i] if hessian_grads is not None else None
 
         if capturable:
             assert param.is_cuda and step_t.is_cuda and bs.is_cuda
 
-        if torch.is_complex(param):
+        if has_complex and torch.is_complex(param):
+            if hess_grad is not None:
+                # The EMA squares the complex gradient, which the real view does not
+                # reproduce
+                _hessian_ema([hess], [hess_grad], beta2, foreach=False)
+                hess_grad = None
             grad = torch.view_as_real(grad)
             exp_avg = torch.view_as_real(exp_avg)
             hess = torch.view_as_real(hess)
+            scratch = torch.view_as_real(scratch) if scratch is not None else None
+            if lookahead_scratch is not None:
+                lookahead_scratch = torch.view_as_real(lookahead_scratch)
             param = torch.view_as_real(param)
 
         # update step
         step_t += 1
 
-        # Perform stepweight decay
-        param.mul_(1 - lr * weight_decay)
-
-        # Decay the first and second moment running average coefficient
-        exp_avg.mul_(beta1).add_(grad, alpha=1 - beta1)
-
-        if capturable:
-            step = step_t
-            # Adafactor RMS
-            step_size = lr * max(1e-3, _rms(param.data))
-            step_size_neg = step_size.neg()
-
-            ratio = (exp_avg.abs() / (rho * bs * hess + 1e-15)).clamp(None, 1)
-            param.addcmul_(exp_avg.sign(), ratio, value=step_size_neg)
-        else:
-            step = step_t.item()
-            # Adafactor RMS
-            step_size_neg = -lr * max(1e-3, _rms(param.data))
-
-            ratio = (exp_avg.abs() / (rho * bs * hess + 1e-15)).clamp(None, 1)
-            param.addcmul_(exp_avg.sign(), ratio, value=step_size_neg)
-
-class SophiaG_RMS(Optimizer):
-    def __init__(
-        self,
-        params,
-        lr=1e-4,
-        betas=(0.965, 0.99),
-        rho=0.04,
-        weight_decay=1e-1,
-        *,
-        maximize: bool = False,
-        capturable: bool = False
-    ):
-        if not 0.0 <= lr:
-            raise ValueError("Invalid learning rate: {}".format(lr))
-        if not 0.0 <= betas[0] < 1.0:
-            raise ValueError("Invalid beta parameter at index 0: {}".format(betas[0]))
-        if not 0.0 <= betas[1] < 1.0:
-            raise ValueError("Invalid beta parameter at index 1: {}".format(betas[1]))
-        if not 0.0 <= rho:
-            raise ValueError("Invalid rho parameter at index 1: {}".format(rho))
-        if not 0.0 <= weight_decay:
-            raise ValueError("Invalid weight_decay value: {}".format(weight_decay))
-        defaults = dict(
-            lr=lr,
-            betas=betas,
-            rho=rho,
-            weight_decay=weight_decay,
-            maximize=maximize,
-            capturable=capturable,
-        )
-        super(SophiaG_RMS, self).__init__(params, defaults)
-
-    def __setstate__(self, state):
-        super().__setstate__(state)
-        for group in self.param_groups:
-            group.setdefault("maximize", False)
-            group.setdefault("capturable", False)
-        state_values = list(self.state.values())
-        step_is_tensor = (len(state_values) != 0) and torch.is_tensor(
-            state_values[0]["step"]
-        )
-        if not step_is_tensor:
-            for s in state_values:
-                s["step"] = torch.tensor(float(s["step"]))
-
-    @torch.no_grad()
-    def update_hessian(self):
-        for group in self.param_groups:
-            beta1, beta2 = group["betas"]
-            for p in group["params"]:
-                if p.grad is None:
-                    continue
-                state = self.state[p]
-
-                if len(state) == 0:
-                    state["step"] = (
-                        torch.zeros((1,), dtype=torch.float, device=p.device)
-                    )
-                    state["rms"] = (
-                        torch.zeros((1,), dtype=torch.float, device=p.device)
-                    )
-                    state["exp_avg"] = torch.zeros_like(
-                        p, memory_format=torch.preserve_format
-                    )
-                    state["hessian"] = torch.zeros_like(
-                        p, memory_format=torch.preserve_format
-                    )
-
-                if "hessian" not in state.keys():
-                    state["hessian"] = torch.zeros_like(
-                        p, memory_format=torch.preserve_format
-                    )
-
-                state["hessian"].mul_(beta2).addcmul_(p.grad, p.grad, value=1 - beta2)
-
-    @torch.no_grad()
-    def step(self, closure=None, bs=5120):
-        loss = None
-        if closure is not None:
-            with torch.enable_grad():
-                loss = closure()
-
-        for group in self.param_groups:
-            params_with_grad = []
-            grads = []
-            exp_avgs = []
-            rmss = []
-            state_steps = []
-            hessian = []
-            beta1, beta2 = group["betas"]
-
-            for p in group["params"]:
-                if p.grad is None:
-                    continue
-                params_with_grad.append(p)
-
-                if p.grad.is_sparse:
-                    raise RuntimeError("does not support sparse gradients")
-                grads.append(p.grad)
-                state = self.state[p]
-                # State initialization
-                if len(state) == 0:
-                    state["step"] = (
-                        torch.zeros((1,), dtype=torch.float, device=p.device)
-                    )
-                    state["rms"] = (
-                        torch.zeros((1,), dtype=torch.float, device=p.device)
-                    )
-                    state["exp_avg"] = torch.zeros_like(
-                        p, memory_format=torch.preserve_format
-                    )
-                    state["hessian"] = torch.zeros_like(
-                        p, memory_format=torch.preserve_format
-                    )
-
-                if "hessian" not in state.keys():
-                    state["hessian"] = torch.zeros_like(
-                        p, memory_format=torch.preserve_format
-                    )
-
-                exp_avgs.append(state["exp_avg"])
-                rmss.append(state["rms"])
-                state_steps.append(state["step"])
-                hessian.append(state["hessian"])
-
-                if self.defaults["capturable"]:
-                    bs = torch.ones((1,), dtype=torch.float, device=p.device) * bs
-
-            sophiag_rms(
-                params_with_grad,
-                grads,
-                exp_avgs,
-                rmss,
-                hessian,
-                state_steps,
-                bs=bs,
+        hess_scale = hessian_scales[i] if hessian_scales is not None else None
+        if hess_grad is not None and hess_scale is not None:
+            # The int8 hessian is requantized before the update, so the EMA is not fused
+            _hessian_ema(
+                [hess], [hess_grad], beta2, foreach=False, hessian_scales=[hess_scale]
+            )
+            hess_grad = None
+
+        if _takes_triton_update(use_triton, capturable, param):
+            if hess_grad is not None:
+                _hessian_ema([hess], [hess_grad], beta2, foreach=False)
+            _triton_sophiag_update(
+                param,
+                grad,
+                exp_avg,
+                hess,
+                rms,
+                lr=lr,
+                one_minus_wd=one_minus_wd,
                 beta1=beta1,
-                beta2=beta2,
-                rho=group["rho"],
-                lr=group["lr"],
-                weight_decay=group["weight_decay"],
-                maximize=group["maximize"],
-                capturable=group["capturable"],
+                rho_bs=rho_bs,
+                hess_scale=hess_scale,
+                rms_mode=rms_mode,
+                maximize=maximize,
+                lookahead_beta=lookahead_beta,
             )
-
-        return loss
-
-
-def sophiag_rms(
-    params: List[Tensor],
-    grads: List[Tensor],
-    exp_avgs: List[Tensor],
-    rmss: List[Tensor],
-    hessian: List[Tensor],
-    state_steps: List[Tensor],
-    capturable: bool = False,
-    *,
-    bs: int,
-    beta1: float,
-    beta2: float,
-    rho: float,
-    lr: float,
-    weight_decay: float,
-    maximize: bool
-):
-
-    if not all(isinstance(t, torch.Tensor) for t in state_steps):
-        raise RuntimeError(
-            "API has changed, `state_steps` argument must contain a list of singleton tensors"
-        )
-
-    func = _single_tensor_sophiag_rms
-
-    func(
-        params,
-        grads,
-        exp_avgs,
-        rmss,
-        hessian,
-        state_steps,
-        bs=bs,
-        beta1=beta1,
-        beta2=beta2,
-        rho=rho,
-        lr=lr,
-        weight_decay=weight_decay,
-        maximize=maximize,
-        capturable=capturable,
-    )
-
-
-
-def _single_tensor_sophiag_rms(
-    params: List[Tensor],
-    grads: List[Tensor],
-    exp_avgs: List[Tensor],
-    rmss: List[Tensor],
-    hessian: List[Tensor],
-    state_steps: List[Tensor],
-    *,
-    bs: int,
-    beta1: float,
-    beta2: float,
-    rho: float,
-    lr: float,
-    weight_decay: float,
-    maximize: bool,
-    capturable: bool
-):
-
-    for i, param in enumerate(params):
-        grad = grads[i] if not maximize else -grads[i]
-        exp_avg = exp_avgs[i]
-        rms = rmss[i]
-        hess = hessian[i]
-        step_t = state_steps[i]
-
-        if capturable:
-            assert param.is_cuda and step_t.is_cuda and bs.is_cuda
-
-        if torch.is_complex(param):
-            grad = torch.view_as_real(grad)
-            exp_avg = torch.view_as_real(exp_avg)
-            rms = torch.view_as_real(rms)
-            hess = torch.view_as_real(hess)
-            param = torch.view_as_real(param)
-
-        # update step
-        step_t += 1
-
-        # Perform stepweight decay
-        param.mul_(1 - lr * weight_decay)
-
-        # Decay the first and second moment running average coefficient
-        exp_avg.mul_(beta1).add_(grad, alpha=1 - beta1)
-
-        if capturable:
-            step = step_t
-            # Adafactor RMS
-            step_size_rel = max(1e-5, _rms(param.data))
-            step_size_neg = lr.neg()
-            rms.sub_(rms).add_(step_size_rel)
-
-            ratio = (exp_avg.abs() / (rho * bs * hess + 1e-15)).clamp(None, step_size_rel)
-            param.addcmul_(exp_avg.sign(), ratio, value=step_size_neg)
-        else:
-            step = step_t.item()
-            # Adafactor RMS
-            step_size_rel = max(1e-5, _rms(param.data))
-            step_size_neg = -lr
-            rms.sub_(rms).add_(step_size_rel)
-
-            ratio = (exp_avg.abs() / (rho * bs * hess + 1e-15)).clamp(None, step_size_rel)
-            param.addcmul_(exp_avg.sign(), ratio, value=step_size_neg)
-
-class SophiaG_OG(Optimizer):
-    def __init__(
-        self,
-        params,
-        lr=1e-4,
-        betas=(0.965, 0.99),
-        rho=0.04,
-        weight_decay=1e-1,
-        *,
-        maximize: bool = False,
-        capturable: bool = False
-    ):
-        if not 0.0 <= lr:
-            raise ValueError("Invalid learning rate: {}".format(lr))
-        if not 0.0 <= betas[0] < 1.0:
-            raise ValueError("Invalid beta parameter at index 0: {}".format(betas[0]))
-        if not 0.0 <= betas[1] < 1.0:
-            raise ValueError("Invalid beta parameter at index 1: {}".format(betas[1]))
-        if not 0.0 <= rho:
-            raise ValueError("Invalid rho parameter at index 1: {}".format(rho))
-        if not 0.0 <= weight_decay:
-            raise ValueError("Invalid weight_decay value: {}".format(weight_decay))
-        defaults = dict(
-            lr=lr,
-            betas=betas,
-            rho=rho,
-            weight_decay=weight_decay,
+            continue
+
+        if hess_scale is not None:
+            hess = dequantize_hessian(hess, hess_scale)
+        update_fn(
+            param,
+            grad,
+            exp_avg,
+            hess,
+            rms,
+            neg_lr=update_neg_lr,
+            one_minus_wd=update_one_minus_wd,
+            beta1=beta1,
+            one_minus_beta1=one_minus_beta1,
+            rho_bs=rho_bs,
+            scratch=scratch,
+            rms_mode=rms_mode,
+            hess_grad=hess_grad,
+            beta2=beta2,
+            lookahead_beta=lookahead_beta,
+            lookahead_scratch=lookahead_scratch,
             maximize=maximize,
-            capturable=capturable,
         )
-        super(SophiaG_OG, self).__init__(params, defaults)
-
-    def __setstate__(self, state):
-        super().__setstate__(state)
-        for group in self.param_groups:
-            group.setdefault("maximize", False)
-            group.setdefault("capturable", False)
-        state_values = list(self.state.values())
-        step_is_tensor = (len(state_values) != 0) and torch.is_tensor(
-            state_values[0]["step"]
-        )
-        if not step_is_tensor:
-            for s in state_values:
-                s["step"] = torch.tensor(float(s["step"]))
-
-    @torch.no_grad()
-    def update_hessian(self):
-        for group in self.param_groups:
-            beta1, beta2 = group["betas"]
-            for p in group["params"]:
-                if p.grad is None:
-                    continue
-                state = self.state[p]
-
-                if len(state) == 0:
-                    state["step"] = (
-                        torch.zeros((1,), dtype=torch.float, device=p.device)
-                    )
-                    state["rms"] = (
-                        torch.zeros((1,), dtype=torch.float, device=p.device)
-                    )
-                    state["exp_avg"] = torch.zeros_like(
-                        p, memory_format=torch.preserve_format
-                    )
-                    state["hessian"] = torch.zeros_like(
-                        p, memory_format=torch.preserve_format
-                    )
-
-                if "hessian" not in state.keys():
-                    state["hessian"] = torch.zeros_like(
-                        p, memory_format=torch.preserve_format
-                    )
-
-                state["hessian"].mul_(beta2).addcmul_(p.grad, p.grad, value=1 - beta2)
-
-    @torch.no_grad()
-    def step(self, closure=None, bs=5120):
-        loss = None
-        if closure is not None:
-            with torch.enable_grad():
-                loss = closure()
-
-        for group in self.param_groups:
-            params_with_grad = []
-            grads = []
-            exp_avgs = []
-            rmss = []
-            state_steps = []
-            hessian = []
-            beta1, beta2 = group["betas"]
-
-            for p in group["params"]:
-                if p.grad is None:
-                    continue
-                params_with_grad.append(p)
-
-                if p.grad.is_sparse:
-                    raise RuntimeError("does not support sparse gradients")
-                grads.append(p.grad)
-                state = self.state[p]
-                # State initialization
-                if len(state) == 0:
-                    state["step"] = (
-                        torch.zeros((1,), dtype=torch.float, device=p.device)
-                    )
-                    state["rms"] = (
-                        torch.zeros((1,), dtype=torch.float, device=p.device)
-                    )
-                    state["exp_avg"] = torch.zeros_like(
-                        p, memory_format=torch.preserve_format
-                    )
-                    state["hessian"] = torch.zeros_like(
-                        p, memory_format=torch.preserve_format
-                    )
-
-                if "hessian" not in state.keys():
-                    state["hessian"] = torch.zeros_like(
-                        p, memory_format=torch.preserve_format
-                    )
-
-                exp_avgs.append(state["exp_avg"])
-                rmss.append(state["rms"])
-                state_steps.append(state["step"])
-                hessian.append(state["hessian"])
-
-                if self.defaults["capturable"]:
-                    bs = torch.ones((1,), dtype=torch.float, device=p.device) * bs
-
-            sophiag_og(
-                params_with_grad,
-                grads,
-                exp_avgs,
-                rmss,
-                hessian,
-                state_steps,
-                bs=bs,
-                beta1=beta1,
-                beta2=beta2,
-                rho=group["rho"],
-                lr=group["lr"],
-                weight_decay=group["weight_decay"],
-                maximize=group["maximize"],
-                capturable=group["capturable"],
-            )
-
-        return loss
-
-
-def sophiag_og(
-    params: List[Tensor],
-    grads: List[Tensor],
-    exp_avgs: List[Tensor],
-    rmss: List[Tensor],
-    hessian: List[Tensor],
-    state_steps: List[Tensor],
-    capturable: bool = False,
-    *,
-    bs: int,
-    beta1: float,
-    beta2: float,
-    rho: float,
-    lr: float,
-    weight_decay: float,
-    maximize: bool
-):
-
-    if not all(isinstance(t, torch.Tensor) for t in state_steps):
-        raise RuntimeError(
-            "API has changed, `state_steps` argument must contain a list of singleton tensors"
-        )
-
-    func = _single_tensor_sophiag_og
-
-    func(
-        params,
-        grads,
-        exp_avgs,
-        rmss,
-        hessian,
-        state_steps,
-        bs=bs,
-        beta1=beta1,
-        beta2=beta2,
-        rho=rho,
-        lr=lr,
-        weight_decay=weight_decay,
-        maximize=maximize,
-        capturable=capturable,
-    )
-
-
-
-def _single_tensor_sophiag_og(
-    params: List[Tensor],
-    grads: List[Tensor],
-    exp_avgs: List[Tensor],
-    rmss: List[Tensor],
-    hessian: List[Tensor],
-    state_steps: List[Tensor],
-    *,
-    bs: int,
-    beta1: float,
-    beta2: float,
-    rho: float,
-    lr: float,
-    weight_decay: float,
-    maximize: bool,
-    capturable: bool
-):
-
-    for i, param in enumerate(params):
-        grad = grads[i] if not maximize else -grads[i]
-        exp_avg = exp_avgs[i]
-        rms = rmss[i]
-        hess = hessian[i]
-        step_t = state_steps[i]
-
-        if capturable:
-            assert param.is_cuda and step_t.is_cuda and bs.is_cuda
-
-        if torch.is_complex(param):
-            grad = torch.view_as_real(grad)
-            exp_avg = torch.view_as_real(exp_avg)
-            rms = torch.view_as_real(rms)
-            hess = torch.view_as_real(hess)
-            param = torch.view_as_real(param)
-
-        # update step
-        step_t += 1
-
-        # Perform stepweight decay
-        param.mul_(1 - lr * weight_decay)
-
-        # Decay the first and second moment running average coefficient
-        exp_avg.mul_(beta1).add_(grad, alpha=1 - beta1)
-
-        if capturable:
-            step = step_t
-            # Adafactor RMS
-            step_size_rel = max(1e-5, _rms(param.data))
-            step_size_neg = lr.neg()
-            rms.sub_(rms).add_(step_size_rel)
-
-            ratio = (exp_avg.abs() / (rho * bs * hess + 1e-15)).clamp(None, 1)
-            param.addcmul_(exp_avg.sign(), ratio, value=step_size_neg)
-        else:
-            step = step_t.item()
-            # Adafactor RMS
-            step_size_rel = max(1e-5, _rms(param.data))
-            step_size_neg = -lr
-            rms.sub_(rms).add_(step_size_rel)
-
-            ratio = (exp_avg.abs() / (rho * bs * hess + 1e-15)).clamp(None, 1)
-            param.addcmul_(exp_avg.sign(), ratio, value=step_size_neg)
-
-
-class SophiaG_RMSD(Optimizer):
-    def __init__(
-        self,
-        params,
-        lr=1e-4,
-        betas=(0.99, 0.99),
-        rho=0.04,
-        weight_decay=1e-1,
-        *,
-        maximize: bool = False,
-        capturable: bool = False
-    ):
-        if not 0.0 <= lr:
-            raise ValueError("Invalid learning rate: {}".format(lr))
-        if not 0.0 <= betas[0] < 1.0:
-            raise ValueError("Invalid beta parameter at index 0: {}".format(betas[0]))
-        if not 0.0 <= betas[1] < 1.0:
-            raise ValueError("Invalid beta parameter at index 1: {}".format(betas[1]))
-        if not 0.0 <= rho:
-            raise ValueError("Invalid rho parameter at index 1: {}".format(rho))
-        if not 0.0 <= weight_decay:
-            raise ValueError("Invalid weight_decay value: {}".format(weight_decay))
-        defaults = dict(
-            lr=lr,
-            betas=betas,
-            rho=rho,
-            weight_decay=weight_decay,
-            maximize=maximize,
-            capturable=capturable,
-        )
-        super(SophiaG_RMSD, self).__init__(params, defaults)
-
-    def __setstate__(self, state):
-        super().__setstate__(state)
-        for group in self.param_groups:
-            group.setdefault("maximize", False)
-            group.setdefault("capturable", False)
-        state_values = list(self.state.values())
-        step_is_tensor = (len(state_values) != 0) and torch.is_tensor(
-            state_values[0]["step"]
-        )
-        if not step_is_tensor:
-            for s in state_values:
-                s["step"] = torch.tensor(float(s["step"]))
-
-    @torch.no_grad()
-    def update_hessian(self):
-        for group in self.param_groups:
-            beta1, beta2 = group["betas"]
-            for p in group["params"]:
-                if p.grad is None:
-                    continue
-                state = self.state[p]
-
-                if len(state) == 0:
-                    state["step"] = (
-                        torch.zeros((1,), dtype=torch.float, device=p.device)
-                    )
-                    state["rms"] = (
-                        torch.zeros((1,), dtype=torch.float, device=p.device)
-                    )
-                    state["exp_avg"] = torch.zeros_like(
-                        p, memory_format=torch.preserve_format
-                    )
-                    state["hessian"] = torch.zeros_like(
-                        p, memory_format=torch.preserve_format
-                    )
-
-                if "hessian" not in state.keys():
-                    state["hessian"] = torch.zeros_like(
-                        p, memory_format=torch.preserve_format
-                    )
-
-                state["hessian"].mul_(beta2).addcmul_(p.grad, p.grad, value=1 - beta2)
-
-    @torch.no_grad()
-    def step(self, closure=None, bs=5120):
-        loss = None
-        if closure is not None:
-            with torch.enable_grad():
-                loss = closure()
-
-        for group in self.param_groups:
-            params_with_grad = []
-            grads = []
-            exp_avgs = []
-            rmss = []
-            state_steps = []
-            hessian = []
-            beta1, beta2 = group["betas"]
-
-            for p in group["params"]:
-                if p.grad is None:
-                    continue
-                params_with_grad.append(p)
-
-                if p.grad.is_sparse:
-                    raise RuntimeError("does not support sparse gradients")
-                grads.append(p.grad)
-                state = self.state[p]
-                # State initialization
-                if len(state) == 0:
-                    state["step"] = (
-                        torch.zeros((1,), dtype=torch.float, device=p.device)
-                    )
-                    state["rms"] = (
-                        torch.zeros((1,), dtype=torch.float, device=p.device)
-                    )
-                    state["exp_avg"] = torch.zeros_like(
-                        p, memory_format=torch.preserve_format
-                    )
-                    state["hessian"] = torch.zeros_like(
-                        p, memory_format=torch.preserve_format
-                    )
-
-                if "hessian" not in state.keys():
-                    state["hessian"] = torch.zeros_like(
-                        p, memory_format=torch.preserve_format
-                    )
-
-                exp_avgs.append(state["exp_avg"])
-                rmss.append(state["rms"])
-                state_steps.append(state["step"])
-                hessian.append(state["hessian"])
-
-                if self.defaults["capturable"]:
-                    bs = torch.ones((1,), dtype=torch.float, device=p.device) * bs
-
-            sophiag_rmsd(
-                params_with_grad,
-                grads,
-                exp_avgs,
-                rmss,
-                hessian,
-                state_steps,
-                bs=bs,
-                beta1=beta1,
-                beta2=beta2,
-                rho=group["rho"],
-                lr=group["lr"],
-                weight_decay=group["weight_decay"],
-                maximize=group["maximize"],
-                capturable=group["capturable"],
-            )
-
-        return loss
-
-
-def sophiag_rmsd(
-    params: List[Tensor],
-    grads: List[Tensor],
-    exp_avgs: List[Tensor],
-    rmss: List[Tensor],
-    hessian: List[Tensor],
-    state_steps: List[Tensor],
-    capturable: bool = False,
-    *,
-    bs: int,
-    beta1: float,
-    beta2: float,
-    rho: float,
-    lr: float,
-    weight_decay: float,
-    maximize: bool
-):
-
-    if not all(isinstance(t, torch.Tensor) for t in state_steps):
-        raise RuntimeError(
-            "API has changed, `state_steps` argument must contain a list of singleton tensors"
-        )
-
-    func = _single_tensor_sophiag_rms
-
-    func(
-        params,
-        grads,
-        exp_avgs,
-        rmss,
-        hessian,
-        state_steps,
-        bs=bs,
-        beta1=beta1,
-        beta2=beta2,
-        rho=rho,
-        lr=lr,
-        weight_decay=weight_decay,
-        maximize=maximize,
-        capturable=capturable,
-    )
-
-
-
-def _single_tensor_sophiag_rmsd(
-    params: List[Tensor],
-    grads: List[Tensor],
-    exp_avgs: List[Tensor],
-    rmss: List[Tensor],
-    hessian: List[Tensor],
-    state_steps: List[Tensor],
-    *,
-    bs: int,
-    beta1: float,
-    beta2: float,
-    rho: float,
-    lr: float,
-    weight_decay: float,
-    maximize: bool,
-    capturable: bool
-):
-
-    for i, param in enumerate(params):
-        grad = grads[i] if not maximize else -grads[i]
-        exp_avg = exp_avgs[i]
-        rms = rmss[i]
-        hess = hessian[i]
-        step_t = state_steps[i]
-
-        if capturable:
-            assert param.is_cuda and step_t.is_cuda and bs.is_cuda
-
-        if torch.is_complex(param):
-            grad = torch.view_as_real(grad)
-            exp_avg = torch.view_as_real(exp_avg)
-            rms = torch.view_as_real(rms)
-            hess = torch.view_as_real(hess)
-            param = torch.view_as_real(param)
-
-        # update step
-        step_t += 1
-
-        # Perform stepweight decay
-        param.mul_(1 - lr * weight_decay)
-
-        # Decay the first and second moment running average coefficient
-        exp_avg_1 = exp_avg.mul(0.95).add(grad, alpha=0.05)
-        exp_avg.mul_(beta1).add_(grad, alpha=1 - beta1)
-
-        if capturable:
-            step = step_t
-            # Adafactor RMS
-            step_size_rel = max(1e-5, _rms(param.data))
-            step_size_neg = lr.neg()
-            rms.sub_(rms).add_(step_size_rel)
-
-            ratio = (exp_avg_1.abs() / (rho * bs * hess + 1e-15)).clamp(None, step_size_rel)
-            param.addcmul_(exp_avg_1.sign(), ratio, value=step_size_neg)
-        else:
-            step = step_t.item()
-            # Adafactor RMS
-            step_size_rel = max(1e-5, _rms(param.data))
-            step_size_neg = -lr
-            rms.sub_(rms).add_(step_size_rel)
-
-            ratio = (exp_avg_1.abs() / (rho * bs * hess + 1e-15)).clamp(None, step_size_rel)
-            param.addcmul_(exp_avg_1.sign(), ratio, value=step_size_neg)
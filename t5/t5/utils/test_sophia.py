@@ -0,0 +1,258 @@
+import pytest
+import torch
+
+from t5.utils import sophia
+from t5.utils.sophia import SophiaG, SophiaG_RMS
+
+
+def _run_steps(params, grads, steps=2, **kwargs):
+    model = [torch.nn.Parameter(p.clone()) for p in params]
+    opt = SophiaG(model, lr=1e-2, **kwargs)
+    for _ in range(steps):
+        for p, grad in zip(model, grads):
+            p.grad = grad.clone()
+        opt.update_hessian()
+        opt.step()
+    return [p.detach() for p in model], opt
+
+
+@pytest.mark.parametrize("foreach", [False, True])
+def test__step__zero_rms_param__steps_by_floor_times_lr(foreach):
+    param = torch.nn.Parameter(torch.zeros(8, 4))
+    grad = torch.randn_like(param)
+    opt = SophiaG([param], lr=1e-2, weight_decay=0.0, foreach=foreach)
+    param.grad = grad
+    # Without a hessian the ratio is clamped to the sign of the moment, so the step is
+    # the RMS floor times the learning rate
+    opt.step()
+
+    torch.testing.assert_close(param.detach(), -1e-2 * 1e-3 * grad.sign())
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="requires CUDA")
+@pytest.mark.parametrize("optimizer_cls", [SophiaG, SophiaG_RMS])
+def test__step__rms_floor__does_not_sync(optimizer_cls):
+    params = [torch.nn.Parameter(torch.randn(8, 4, device="cuda")) for _ in range(2)]
+    opt = optimizer_cls(params, lr=1e-2, foreach=False)
+    for p in params:
+        p.grad = torch.randn_like(p)
+    # The first step creates the state, which is not part of the check
+    opt.step()
+
+    torch.cuda.set_sync_debug_mode("error")
+    try:
+        opt.step()
+    finally:
+        torch.cuda.set_sync_debug_mode("default")
+
+
+def _step_with_frozen_group(**kwargs):
+    device = "cuda" if kwargs.get("use_triton") else "cpu"
+    trained = [torch.nn.Parameter(torch.randn(8, 4, device=device)) for _ in range(2)]
+    frozen = [torch.nn.Parameter(torch.randn(8, 4, device=device))]
+    opt = SophiaG([{"params": trained}, {"params": frozen}], lr=1e-2, **kwargs)
+
+    before = [p.detach().clone() for p in trained + frozen]
+    for p in trained:
+        p.grad = torch.randn_like(p)
+    opt.update_hessian()
+    opt.step()
+
+    assert not torch.equal(before[0], trained[0].detach())
+    assert torch.equal(before[2], frozen[0].detach())
+
+
+@pytest.mark.skipif(
+    not (sophia._HAS_TRITON and torch.cuda.is_available()),
+    reason="requires triton and CUDA",
+)
+def test__step__flat_triton_group_without_grads__is_skipped():
+    _step_with_frozen_group(use_triton=True, flatten_state=True)
+
+
+def test__step__stacked_group_without_grads__is_skipped():
+    _step_with_frozen_group(use_compile=True, flatten_state=True)
+
+
+def test__step__stacked_rms_scale__matches_single_tensor_update():
+    torch.manual_seed(0)
+    params = [torch.randn(8, 4) for _ in range(3)]
+    grads = [torch.randn_like(p) for p in params]
+
+    expected, _ = _run_steps(params, grads, rms_mode="rms_scale", foreach=False)
+    actual, _ = _run_steps(
+        params, grads, rms_mode="rms_scale", use_compile=True, flatten_state=True
+    )
+
+    for e, a in zip(expected, actual):
+        torch.testing.assert_close(a, e)
+
+
+@pytest.mark.skipif(not sophia._HAS_TRITON, reason="requires triton")
+def test__step__stacked_cpu_group__allocates_no_scratch_buffers():
+    params = [torch.nn.Parameter(torch.randn(8, 4)) for _ in range(2)]
+    opt = SophiaG(params, use_triton=True, flatten_state=True)
+    for p in params:
+        p.grad = torch.randn_like(p)
+    opt.step()
+
+    assert opt._scratch_buffers == {}
+
+
+@pytest.mark.parametrize("rms_mode", ["rms_scale", "clamp_rms", "none"])
+@pytest.mark.parametrize("maximize", [False, True])
+@pytest.mark.parametrize("lookahead_beta", [None, 0.9])
+def test__step__foreach__matches_single_tensor_update(
+    rms_mode, maximize, lookahead_beta
+):
+    torch.manual_seed(0)
+    params = [torch.randn(8, 4), torch.randn(3), torch.randn(8, 4, dtype=torch.double)]
+    grads = [torch.randn_like(p) for p in params]
+    kwargs = dict(rms_mode=rms_mode, maximize=maximize, lookahead_beta=lookahead_beta)
+
+    expected, _ = _run_steps(params, grads, foreach=False, **kwargs)
+    actual, _ = _run_steps(params, grads, foreach=True, **kwargs)
+
+    for e, a in zip(expected, actual):
+        torch.testing.assert_close(a, e)
+
+
+def test__step__compiled_variants_in_one_process__match_single_tensor_update():
+    torch.manual_seed(0)
+    params = [torch.randn(8, 4), torch.randn(3), torch.randn(5, 2, 2)]
+    grads = [torch.randn_like(p) for p in params]
+
+    # The variants share the compile cache of _sophiag_update
+    for rms_mode in ("rms_scale", "clamp_rms", "none"):
+        for lookahead_beta in (None, 0.9):
+            kwargs = dict(rms_mode=rms_mode, lookahead_beta=lookahead_beta)
+            expected, _ = _run_steps(params, grads, foreach=False, **kwargs)
+            actual, _ = _run_steps(params, grads, use_compile=True, **kwargs)
+
+            for e, a in zip(expected, actual):
+                torch.testing.assert_close(a, e)
+
+
+def test__step__compiled_lr_change__reuses_lr_tensors():
+    torch.manual_seed(0)
+    params = [torch.randn(8, 4), torch.randn(3)]
+    grads = [torch.randn_like(p) for p in params]
+
+    results = []
+    for kwargs in ({"foreach": False}, {"use_compile": True}):
+        model = [torch.nn.Parameter(p.clone()) for p in params]
+        opt = SophiaG(model, lr=1e-2, **kwargs)
+        lr_tensors = []
+        for lr in (1e-2, 5e-3):
+            opt.param_groups[0]["lr"] = lr
+            for p, grad in zip(model, grads):
+                p.grad = grad.clone()
+            opt.update_hessian()
+            opt.step()
+            lr_tensors.append(dict(opt._lr_tensors))
+        results.append([p.detach() for p in model])
+
+    assert len(lr_tensors[1]) == 1
+    assert [id(t) for t in lr_tensors[0].values()] == [
+        id(t) for t in lr_tensors[1].values()
+    ]
+    for expected, actual in zip(*results):
+        torch.testing.assert_close(actual, expected)
+
+
+def test__step__group_state_dtype__overrides_default():
+    reduced = torch.nn.Parameter(torch.randn(8, 4))
+    full = torch.nn.Parameter(torch.randn(8, 4))
+    opt = SophiaG(
+        [{"params": [reduced]}, {"params": [full], "state_dtype": None}],
+        state_dtype=torch.bfloat16,
+    )
+    for p in (reduced, full):
+        p.grad = torch.randn_like(p)
+    opt.update_hessian()
+    opt.step()
+
+    assert opt.state[reduced]["exp_avg"].dtype == torch.bfloat16
+    assert opt.state[reduced]["hessian"].dtype == torch.bfloat16
+    assert opt.state[full]["exp_avg"].dtype == torch.float32
+    assert opt.state[full]["hessian"].dtype == torch.float32
+
+
+def test__load_state_dict__reduced_precision_state__round_trips():
+    torch.manual_seed(0)
+    params = [torch.randn(8, 4), torch.randn(3)]
+    grads = [torch.randn_like(p) for p in params]
+    kwargs = dict(state_dtype=torch.bfloat16, foreach=False)
+    trained, opt = _run_steps(params, grads, **kwargs)
+
+    model = [torch.nn.Parameter(p.clone()) for p in trained]
+    reloaded = SophiaG(model, lr=1e-2, **kwargs)
+    reloaded.load_state_dict(opt.state_dict())
+
+    for p, q in zip(opt.param_groups[0]["params"], model):
+        for key in ("exp_avg", "hessian"):
+            assert reloaded.state[q][key].dtype == torch.bfloat16
+            assert torch.equal(reloaded.state[q][key], opt.state[p][key])
+        assert torch.equal(reloaded.state[q]["step"], opt.state[p]["step"])
+
+    for optimizer, ps in ((opt, opt.param_groups[0]["params"]), (reloaded, model)):
+        for p, grad in zip(ps, grads):
+            p.grad = grad.clone()
+        optimizer.step()
+    for p, q in zip(opt.param_groups[0]["params"], model):
+        torch.testing.assert_close(q.detach(), p.detach())
+
+
+def test__init__int8_hessian_without_triton__raises():
+    params = [torch.nn.Parameter(torch.randn(8, 4))]
+    with pytest.raises(ValueError):
+        SophiaG(params, hessian_dtype=torch.int8)
+
+
+@pytest.mark.skipif(not sophia._HAS_TRITON, reason="requires triton")
+@pytest.mark.parametrize(
+    "device",
+    [
+        "cpu",
+        pytest.param(
+            "cuda",
+            marks=pytest.mark.skipif(
+                not torch.cuda.is_available(), reason="requires CUDA"
+            ),
+        ),
+    ],
+)
+def test__step__int8_hessian__matches_float_hessian(device):
+    torch.manual_seed(0)
+    params = [torch.randn(64, 16, device=device), torch.randn(300, device=device)]
+    grads = [torch.randn_like(p) for p in params]
+
+    expected, _ = _run_steps(params, grads, steps=5, use_triton=True)
+    actual, opt = _run_steps(
+        params, grads, steps=5, use_triton=True, hessian_dtype=torch.int8
+    )
+
+    assert opt.state[opt.param_groups[0]["params"][0]]["hessian"].dtype == torch.int8
+    for e, a in zip(expected, actual):
+        torch.testing.assert_close(a, e, rtol=0, atol=5e-3)
+
+
+@pytest.mark.skipif(
+    not (sophia._HAS_TRITON and torch.cuda.is_available()),
+    reason="requires triton and CUDA",
+)
+def test__int8_hessian_ema__triton_kernel__matches_reference():
+    torch.manual_seed(0)
+    grad = torch.randn(1000, device="cuda")
+    hess = torch.zeros(1000, dtype=torch.int8, device="cuda")
+    scale = torch.zeros(-(-1000 // sophia.HESSIAN_BLOCK_SIZE), device="cuda")
+    sophia._int8_hessian_ema(hess, grad, scale, beta2=0.9)
+
+    expected = torch.zeros_like(grad).mul_(0.9).addcmul_(grad, grad, value=0.1)
+    # A code is off by at most 0.5, which is below 1% of the scale of its block
+    torch.testing.assert_close(
+        sophia.dequantize_hessian(hess, scale),
+        expected,
+        rtol=0,
+        atol=0.01 * expected.max().item(),
+    )
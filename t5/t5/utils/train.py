@@ -1,3 +1,4 @@
+import contextlib
 import time
 
 import evaluate
@@ -12,6 +13,7 @@ from .sophia import SophiaG
 from .sophia import SophiaG_RMS
 from .sophia import SophiaG_RMSD
 from .sophia import SophiaG_OG
+from .sophia import dequantize_hessian
 
 
 def maybe_save_checkpoint(accelerator, args):
@@ -85,13 +87,10 @@ def maybe_grad_clip_and_grad_calc(accelerator, model, args):
 
     if args.logging.grad_l2:
         if grad_l2 is None:
+            # The norms stay on device, a single item() instead of one sync per parameter
+            grads = [p.grad.detach() for p in model.parameters() if p.grad is not None]
             grad_l2 = (
-                sum(
-                    p.grad.detach().data.norm(2).item() ** 2
-                    for p in model.parameters()
-                    if p.grad is not None
-                )
-                ** 0.5
+                torch.stack(torch._foreach_norm(grads)).norm(2).item() if grads else 0.0
             )
 
         return {"grad_l2": grad_l2}
@@ -99,6 +98,19 @@ def maybe_grad_clip_and_grad_calc(accelerator, model, args):
         return {}
 
 
+def maybe_no_sync(accelerator, model, sync):
+    # With gradient accumulation only the last micro-batch needs the DDP all-reduce, the others skip it
+    if sync:
+        return contextlib.nullcontext()
+    return accelerator.no_sync(model)
+
+
+def _dequantized_hessian(state):
+    if 'hessian_scale' in state:
+        return dequantize_hessian(state['hessian'], state['hessian_scale'])
+    return state['hessian']
+
+
 def extra_stats(args, model, optimizer):
     stats = {}
 
@@ -109,31 +121,38 @@ def extra_stats(args, model, optimizer):
         stats["weights_l2"] = weights_l2
     
     if args.optim.name == 'sophia' or args.optim.name == 'sophia_og':
-        LL = len(optimizer.state_dict()['state'])
+        # state_dict() copies the whole state mapping, so it is built once and not for every parameter
+        opt_state = optimizer.state_dict()['state']
+        LL = len(opt_state)
         num_param = 0
         num_effective = 0
-        hessian_norm2 = 0
+        hessian_norms = []
         for jj in range(LL):
-            num_param += optimizer.state_dict()['state'][jj]['exp_avg'].numel()
-            num_effective += torch.sum(torch.abs(optimizer.state_dict()['state'][jj]['exp_avg']) < args.optim.rho * 5120 * optimizer.state_dict()['state'][jj]['hessian'])
+            num_param += opt_state[jj]['exp_avg'].numel()
+            hessian = _dequantized_hessian(opt_state[jj])
+            num_effective += torch.sum(torch.abs(opt_state[jj]['exp_avg']) < args.optim.rho * 5120 * hessian)
             #hessian_norm += optimizer.state_dict()['state'][jj]['hessian'].detach().norm(1).item()
-            hessian_norm2 += optimizer.state_dict()['state'][jj]['hessian'].detach().norm(2).item() ** 2
-        hessian_norm2 = hessian_norm2 ** 0.5
+            hessian_norms.append(hessian.detach().norm(2))
+        hessian_norm2 = torch.stack(hessian_norms).norm(2).item()
 
         stats["hessian_l2"] = hessian_norm2
         stats["win_rate"] = num_effective / num_param
 
     if args.optim.name == "sophiarms" or args.optim.name == "sophiarmsd":
-        LL = len(optimizer.state_dict()['state'])
+        opt_state = optimizer.state_dict()['state']
+        LL = len(opt_state)
         num_param = 0
         num_effective = 0
-        hessian_norm2 = 0
+        hessian_norms = []
         for jj in range(LL):
-            num_param += optimizer.state_dict()['state'][jj]['exp_avg'].numel()
-            num_effective += torch.sum(torch.abs(optimizer.state_dict()['state'][jj]['exp_avg']) < args.optim.rho * 5120 * optimizer.state_dict()['state'][jj]['hessian'] * optimizer.state_dict()['state'][jj]['rms']) 
+            num_param += opt_state[jj]['exp_avg'].numel()
+            hessian = _dequantized_hessian(opt_state[jj])
+            # The threshold is scaled by the rms in place, which saves a temporary the size of the parameter
+            threshold = torch.mul(hessian, args.optim.rho * 5120).mul_(opt_state[jj]['rms'])
+            num_effective += torch.sum(torch.abs(opt_state[jj]['exp_avg']) < threshold)
             #hessian_norm += optimizer.state_dict()['state'][jj]['hessian'].detach().norm(1).item()
-            hessian_norm2 += optimizer.state_dict()['state'][jj]['hessian'].detach().norm(2).item() ** 2
-        hessian_norm2 = hessian_norm2 ** 0.5
+            hessian_norms.append(hessian.detach().norm(2))
+        hessian_norm2 = torch.stack(hessian_norms).norm(2).item()
 
         stats["hessian_l2"] = hessian_norm2
         stats["win_rate"] = num_effective / num_param
@@ -323,13 +342,14 @@ def train(
                 break
 
             if sophia_update:
-                outputs = model(**batch)
-                samp_dist = torch.distributions.Categorical(logits=outputs.logits)
-                y_sample = samp_dist.sample()
-                loss = torch.nn.CrossEntropyLoss(ignore_index=-100)(
-                    outputs.logits.view(-1, outputs.logits.size(-1)), y_sample.view(-1)
-                )
-                accelerator.backward(loss / args.optim.grad_acc)
+                with maybe_no_sync(accelerator, model, sophia_batches + 1 == args.optim.grad_acc):
+                    outputs = model(**batch)
+                    samp_dist = torch.distributions.Categorical(logits=outputs.logits)
+                    y_sample = samp_dist.sample()
+                    loss = torch.nn.CrossEntropyLoss(ignore_index=-100)(
+                        outputs.logits.view(-1, outputs.logits.size(-1)), y_sample.view(-1)
+                    )
+                    accelerator.backward(loss / args.optim.grad_acc)
                 sophia_batches += 1
 
                 if sophia_batches == args.optim.grad_acc:
@@ -340,8 +360,9 @@ def train(
 
                 continue
 
-            loss, stats = forward(model, batch)
-            accelerator.backward(loss / args.optim.grad_acc)
+            with maybe_no_sync(accelerator, model, batch_id % args.optim.grad_acc == 0):
+                loss, stats = forward(model, batch)
+                accelerator.backward(loss / args.optim.grad_acc)
             train_averager.update(stats)
 
             if batch_id % args.optim.grad_acc == 0: